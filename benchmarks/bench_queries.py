@@ -0,0 +1,238 @@
+"""Бенчмарк запросов админки и истории на синтетических данных.
+
+Засевает базу (по умолчанию 100k бесед × 20 сообщений = 2M строк), затем
+прогоняет эндпоинты через TestClient и печатает p50/p95/max по каждому.
+База должна быть отдельной — скрипт пишет в неё напрямую.
+
+    DATABASE_URL=postgresql+psycopg2://.../bench python benchmarks/bench_queries.py --seed
+    python benchmarks/bench_queries.py --json out.json --compare baseline.json
+    python benchmarks/bench_queries.py --explain            # планы SQL каждого запроса
+
+--compare помечает REGRESSION, если p50 вырос больше чем на --threshold (доля).
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+ADMIN_TOKEN = "bench"
+os.environ.setdefault("ADMIN_TOKEN", ADMIN_TOKEN)
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("ADMIN_COUNT_STRATEGY", "exact")
+
+import main  # noqa: E402
+from sqlalchemy import event, func, select  # noqa: E402
+
+
+# ── Seed ───────────────────────────────────────────────────────────────────
+# Генерация целиком на стороне БД (generate_series / рекурсивный CTE) —
+# миллионы строк без прогона через Python.
+
+ORIGINS = ["https://bizpartner.pl", "https://bizpartner.pl/ru", "https://example.com", ""]
+
+def _series(dialect: str, n: int) -> str:
+    if dialect == "postgresql":
+        return f"SELECT generate_series(1, {n}) AS n"
+    return f"WITH RECURSIVE g(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM g WHERE n < {n}) SELECT n FROM g"
+
+def _ts(dialect: str, seconds_expr: str) -> str:
+    if dialect == "postgresql":
+        return f"(TIMESTAMP '2025-01-01' + ({seconds_expr}) * INTERVAL '1 second')"
+    return f"(strftime('%Y-%m-%d %H:%M:%S', '2025-01-01', '+' || ({seconds_expr}) || ' seconds') || '.000000')"
+
+def _exec(conn, sql: str) -> None:
+    if conn.dialect.paramstyle in ("format", "pyformat"):
+        sql = sql.replace("%", "%%")  # psycopg2: литеральный % в тексте запроса
+    conn.exec_driver_sql(sql)
+
+def seed(conversations: int, per_conversation: int) -> None:
+    engine = main.engine
+    dialect = engine.dialect.name
+    origins = "CASE n % 4 " + " ".join(f"WHEN {i} THEN '{o}'" for i, o in enumerate(ORIGINS)) + " END"
+    roles = "CASE n % 4 WHEN 0 THEN 'user' WHEN 1 THEN 'assistant' WHEN 2 THEN 'tool' ELSE 'assistant' END"
+    conv_id = f"((n - 1) / {per_conversation} + 1)"
+    started = time.monotonic()
+    with engine.begin() as conn:
+        _exec(
+            conn,
+            "INSERT INTO conversations (thread_id, origin, lead_id, created_at, messages_count, tool_calls_count, last_message_at) "
+            f"SELECT 'thread_bench_' || n, {origins}, CASE WHEN n % 10 = 0 THEN n ELSE NULL END, "
+            f"{_ts(dialect, f'n * {per_conversation} * 60')}, 0, 0, {_ts(dialect, f'n * {per_conversation} * 60')} "
+            f"FROM ({_series(dialect, conversations)}) s"
+        )
+    print(f"seeded {conversations} conversations in {time.monotonic() - started:.1f}s")
+    # сообщения — пачками, чтобы не держать одну гигантскую транзакцию
+    total = conversations * per_conversation
+    chunk = 200_000
+    for lo in range(0, total, chunk):
+        hi = min(total, lo + chunk)
+        with engine.begin() as conn:
+            _exec(
+                conn,
+                "INSERT INTO messages (conversation_id, role, content, tool_name, created_at) "
+                f"SELECT {conv_id}, {roles}, 'synthetic message ' || n || ' about company registration and accounting', "
+                "CASE WHEN n % 4 = 2 THEN 'create_lead' ELSE NULL END, "
+                f"{_ts(dialect, f'n * 60')} "
+                f"FROM (SELECT n + {lo} AS n FROM ({_series(dialect, hi - lo)}) s0) s"
+            )
+        print(f"  messages {hi}/{total} ({time.monotonic() - started:.1f}s)")
+    # статистику бесед пересчитывает миграция 5 — после индексов миграции 3
+    for item in main._apply_online_migrations(engine):  # индексы и FTS — после заливки, как на проде
+        print(f"  online migration {item['version']} {item['name']} in {item['elapsed_s']}s")
+    with engine.begin() as conn:
+        if dialect == "postgresql":
+            conn.exec_driver_sql("ANALYZE conversations")
+            conn.exec_driver_sql("ANALYZE messages")
+        else:
+            conn.exec_driver_sql("ANALYZE")
+    print(f"seed done in {time.monotonic() - started:.1f}s")
+
+
+# ── Queries ────────────────────────────────────────────────────────────────
+
+def _cursor(client, path: str, params: dict) -> str:
+    r = client.get(path, params={**params, "paginate": "keyset"}, headers={"x-admin-token": ADMIN_TOKEN}).json()
+    return r["next_cursor"]
+
+def cases(client, n_conv: int) -> list[tuple[str, str, dict]]:
+    mid = max(1, n_conv // 2)
+    thread = f"thread_bench_{mid}"
+    deep = max(0, n_conv // 2)
+    conv_cursor = _cursor(client, "/admin/conversations", {"limit": 50})
+    msg_cursor = _cursor(client, "/admin/messages", {"limit": 50})
+    return [
+        ("conversations.default", "/admin/conversations", {}),
+        ("conversations.count_none", "/admin/conversations", {"count": "none"}),
+        ("conversations.origin", "/admin/conversations", {"origin": "https://bizpartner.pl", "count": "none"}),
+        ("conversations.has_lead", "/admin/conversations", {"has_lead": "1", "count": "none"}),
+        ("conversations.by_last_message", "/admin/conversations", {"sort_by": "last_message_at", "count": "none"}),
+        ("conversations.by_messages_count", "/admin/conversations", {"sort_by": "messages_count", "count": "none"}),
+        ("conversations.deep_offset", "/admin/conversations", {"offset": deep, "count": "none"}),
+        ("conversations.keyset_page2", "/admin/conversations", {"cursor": conv_cursor, "count": "none"}),
+        ("messages.default", "/admin/messages", {}),
+        ("messages.count_none", "/admin/messages", {"count": "none"}),
+        ("messages.role_user", "/admin/messages", {"role": "user", "count": "none"}),
+        ("messages.tool_calls", "/admin/messages", {"tool_name": "*", "count": "none"}),
+        ("messages.date_range", "/admin/messages", {"from": "2025-02-01T00:00:00", "to": "2025-02-02T00:00:00", "count": "none"}),
+        ("messages.thread", "/admin/messages", {"thread_id": thread, "count": "none"}),
+        ("messages.search", "/admin/messages", {"search": "registration", "count": "none"}),
+        ("messages.deep_offset", "/admin/messages", {"offset": deep, "count": "none"}),
+        ("messages.keyset_page2", "/admin/messages", {"cursor": msg_cursor, "count": "none"}),
+        ("conversation.messages", f"/admin/conversations/{mid}/messages", {}),
+        ("thread.messages", f"/admin/threads/{thread}/messages", {}),
+        ("history.first_page", "/chat/history", {"thread_id": thread, "limit": 50}),
+        ("history.latest", "/chat/history", {"thread_id": thread, "limit": 10, "before": "latest"}),
+    ]
+
+class StatementLog:
+    def __init__(self):
+        self.statements: list[tuple[str, object]] = []
+        self.enabled = False
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled and not statement.lstrip().upper().startswith("EXPLAIN"):
+            self.statements.append((statement, parameters))
+
+def explain(statements) -> None:
+    dialect = main.engine.dialect.name
+    prefix = "EXPLAIN ANALYZE " if dialect == "postgresql" else "EXPLAIN QUERY PLAN "
+    raw = main.engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        for statement, params in statements:
+            cur.execute(prefix + statement, params)
+            for row in cur.fetchall():
+                print("      " + " ".join(str(v) for v in row))
+        raw.rollback()
+    finally:
+        raw.close()
+
+def run(repeat: int, warmup: int, show_plans: bool) -> dict:
+    from fastapi.testclient import TestClient
+
+    with main.engine.connect() as conn:
+        n_conv = conn.execute(select(func.count(main.Conversation.id))).scalar() or 0
+        n_msg = conn.execute(select(func.count(main.Message.id))).scalar() or 0
+    print(f"{main.engine.dialect.name}: {n_conv} conversations, {n_msg} messages")
+
+    log = StatementLog()
+    event.listen(main.engine, "before_cursor_execute", log)
+    headers = {"x-admin-token": ADMIN_TOKEN}
+    results = {}
+    with TestClient(main.app) as client:
+        for name, path, params in cases(client, n_conv):
+            for _ in range(warmup):
+                client.get(path, params=params, headers=headers)
+            samples = []
+            for i in range(repeat):
+                main._count_cache.clear()
+                log.statements.clear()
+                log.enabled = i == 0
+                t0 = time.perf_counter()
+                r = client.get(path, params=params, headers=headers)
+                samples.append((time.perf_counter() - t0) * 1000)
+                log.enabled = False
+                if r.status_code != 200:
+                    print(f"  {name}: HTTP {r.status_code} {r.text[:200]}")
+                    break
+                if i == 0 and show_plans:
+                    print(f"  {name}:")
+                    explain(list(log.statements))
+            samples.sort()
+            results[name] = {
+                "p50_ms": round(statistics.median(samples), 2),
+                "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+                "max_ms": round(samples[-1], 2),
+            }
+    event.remove(main.engine, "before_cursor_execute", log)
+    return {"dialect": main.engine.dialect.name, "conversations": n_conv, "messages": n_msg, "results": results}
+
+def report(report_data: dict, baseline: dict | None, threshold: float) -> int:
+    regressions = 0
+    print(f"\n{'query':36} {'p50':>9} {'p95':>9} {'max':>9}  vs baseline")
+    for name, r in report_data["results"].items():
+        line = f"{name:36} {r['p50_ms']:9.2f} {r['p95_ms']:9.2f} {r['max_ms']:9.2f}"
+        base = (baseline or {}).get("results", {}).get(name)
+        if base:
+            delta = (r["p50_ms"] - base["p50_ms"]) / max(base["p50_ms"], 0.01)
+            line += f"  {delta:+.0%}"
+            if delta > threshold:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+    return regressions
+
+def main_cli() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--seed", action="store_true", help="заполнить базу синтетическими данными")
+    ap.add_argument("--conversations", type=int, default=100_000)
+    ap.add_argument("--messages-per-conversation", type=int, default=20)
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--warmup", type=int, default=2)
+    ap.add_argument("--explain", action="store_true", help="печатать планы SQL-запросов каждого эндпоинта")
+    ap.add_argument("--json", help="сохранить результаты в файл")
+    ap.add_argument("--compare", help="сравнить с ранее сохранённым --json")
+    ap.add_argument("--threshold", type=float, default=0.25)
+    args = ap.parse_args()
+
+    if not main.engine:
+        print("DATABASE_URL is not configured", file=sys.stderr)
+        return 2
+    if args.seed:
+        seed(args.conversations, args.messages_per_conversation)
+    data = run(args.repeat, args.warmup, args.explain)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(data, f, indent=2)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    return 1 if report(data, baseline, args.threshold) else 0
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
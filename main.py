@@ -4,24 +4,54 @@
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
-from openai import OpenAI
-import os, time, json, asyncio, csv, io
-import requests
-from datetime import datetime, timezone
+from openai import AsyncOpenAI, APIError
+import os, time, json, asyncio, csv, io, random, queue, threading, re, hashlib, base64, zlib, bisect
+import httpx
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
 from typing import Optional
+from urllib.parse import quote
 
 # ── Persistence (SQLAlchemy) ───────────────────────────────────────────────
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Text, DateTime, ForeignKey, JSON as SA_JSON, func
+    create_engine, Column, Integer, String, Text, DateTime, Boolean, Float, ForeignKey, JSON as SA_JSON, func, insert,
+    select, update, and_, or_, case, inspect, bindparam, literal_column, table, column, event, DDL,
 )
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
 DEBUG = os.getenv("DEBUG", "0") in {"1", "true", "True", "yes", "on"}
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    message_writer.start()
+    warm_threads.start()
+    opening_answers.start()
+    yield
+    await import_jobs.stop()
+    await opening_answers.stop()
+    await warm_threads.stop()
+    await run_watcher.stop()
+    await client.close()
+    await bitrix.aclose()
+    await asyncio.to_thread(message_writer.stop)
+
+app = FastAPI(lifespan=lifespan)
 
 # ── OpenAI ────────────────────────────────────────────────────────────────
-client       = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Один общий async-клиент на воркер: keep-alive пул соединений переиспользуется
+# всеми запросами, вызовы не блокируют event loop.
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+openai_http = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+        keepalive_expiry=30.0,
+    ),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+client       = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=openai_http)
 ASSISTANT_ID = os.getenv("ASSISTANT_ID")            # Railway → Variables
 BITRIX_WEBHOOK_URL = os.getenv("BITRIX_WEBHOOK_URL") or os.getenv("BITRIX_WEBHOOK")
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -29,7 +59,8 @@ ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 # ── DB setup ───────────────────────────────────────────────────────────────
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, pool_pre_ping=True) if DATABASE_URL else None
+# JSON-колонки пишутся без \uXXXX — текст в БД и в выгрузках читаемый
+engine = create_engine(DATABASE_URL, pool_pre_ping=True, json_serializer=lambda obj: json.dumps(obj, ensure_ascii=False)) if DATABASE_URL else None
 SessionLocal = sessionmaker(bind=engine) if engine else None
 
 class Conversation(Base):
@@ -39,29 +70,387 @@ class Conversation(Base):
     lead_id = Column(Integer, nullable=True)
     origin = Column(String(256), nullable=True)
     created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    # денормализованная статистика, см. _write_messages / _backfill_conversation_stats
+    messages_count = Column(Integer, nullable=False, default=0, server_default="0")
+    tool_calls_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_at = Column(DateTime, nullable=True)  # при создании = created_at
+    first_user_message_at = Column(DateTime, nullable=True)
+    last_user_message_at = Column(DateTime, nullable=True)
 
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
 
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True)
-    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False, index=True)
+    conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)  # индексы — см. QUERY_INDEXES
     role = Column(String(32), nullable=False)  # user | assistant | tool
     content = Column(Text, nullable=False)
     tool_name = Column(String(128), nullable=True)
     tool_args = Column(SA_JSON, nullable=True)
     created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    # ключи дедупликации импорта из OpenAI, см. миграцию 4
+    external_id = Column(String(64), nullable=True)   # id сообщения в OpenAI (msg_…)
+    content_hash = Column(String(32), nullable=True)  # _content_hash(role, content)
 
     conversation = relationship("Conversation", back_populates="messages")
 
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+    version = Column(Integer, primary_key=True)
+    name = Column(String(128), nullable=False)
+    applied_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+class ImportJob(Base):
+    """Фоновый импорт тредов из OpenAI, см. ImportJobRunner."""
+    __tablename__ = "import_jobs"
+    id = Column(Integer, primary_key=True)
+    status = Column(String(16), nullable=False, default="pending")  # pending|running|completed|failed|cancelled|interrupted
+    scope = Column(String(16), nullable=False)  # threads | all
+    thread_ids = Column(SA_JSON, nullable=True)  # для scope=threads
+    origin = Column(String(256), nullable=True)
+    force = Column(Boolean, nullable=False, default=False)
+    concurrency = Column(Integer, nullable=False, default=4)
+    total = Column(Integer, nullable=False, default=0)
+    processed = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    imported = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    # точка продолжения: все позиции <= resume_after обработаны (позиция — индекс
+    # в thread_ids с 1 или conversations.id для scope=all)
+    resume_after = Column(Integer, nullable=False, default=0)
+    failed_threads = Column(SA_JSON, nullable=True)  # повторяются первыми при resume
+    last_error = Column(Text, nullable=True)
+    elapsed_s = Column(Float, nullable=False, default=0.0)  # суммарно по всем запускам
+    created_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)
+
+class CacheGeneration(Base):
+    """Поколение in-process кэша: сброс увеличивает его, воркеры сверяются по TTL."""
+    __tablename__ = "cache_generations"
+    name = Column(String(64), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+
+# ── Schema migrations ──────────────────────────────────────────────────────
+# create_all создаёт только недостающие таблицы. Всё, что меняет существующие
+# (колонки, индексы, FTS), — версионированные миграции двух видов:
+#  • обычные — только дешёвые изменения каталога (ADD COLUMN без перезаписи
+#    таблицы). Применяются при старте, каждая в своей транзакции, на Postgres
+#    под advisory lock и с lock_timeout; ошибка останавливает запуск воркера.
+#  • online=True — тяжёлые: индексы, backfill'ы. При старте не применяются,
+#    запускаются явно: `python main.py migrate` или POST /admin/maintenance/migrations.
+#    Функция получает engine и сама управляет транзакциями: индексы на Postgres
+#    строятся CONCURRENTLY в autocommit, backfill'ы идут пачками.
+# Код, зависящий от online-миграции, проверяет её через _migration_applied().
+MIGRATIONS: list[tuple[int, str, object, bool]] = []
+_applied_migrations: set[int] = set()
+_migrations_checked_at = 0.0
+MIGRATION_LOCK_ID = 724311
+ONLINE_MIGRATION_LOCK_ID = 724312
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+MIGRATION_STATE_TTL = 30.0  # как часто воркер перечитывает schema_migrations
+
+def _migration(version: int, name: str, *, online: bool = False):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn, online))
+        return fn
+    return register
+
+def _load_applied_migrations(engine) -> set[int]:
+    global _migrations_checked_at
+    with engine.connect() as conn:
+        versions = set(conn.execute(select(SchemaMigration.version)).scalars())
+    _applied_migrations.update(versions)
+    _migrations_checked_at = time.monotonic()
+    return versions
+
+def _migration_applied(version: int) -> bool:
+    # online-миграцию мог применить другой процесс — перечитываем не чаще раза в MIGRATION_STATE_TTL
+    if version in _applied_migrations:
+        return True
+    if engine is None:
+        return False
+    if time.monotonic() - _migrations_checked_at >= MIGRATION_STATE_TTL:
+        try:
+            _load_applied_migrations(engine)
+        except Exception as e:
+            if DEBUG:
+                print(f"[db] migration state refresh error: {e}")
+    return version in _applied_migrations
+
+def _apply_migrations(engine) -> None:
+    for version, name, fn, online in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if online:
+            continue
+        with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                conn.exec_driver_sql(f"SELECT pg_advisory_xact_lock({MIGRATION_LOCK_ID})")
+                # ALTER TABLE в очереди за долгой транзакцией блокировал бы все записи за собой
+                conn.exec_driver_sql(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+            if conn.execute(select(SchemaMigration.version).where(SchemaMigration.version == version)).first() is None:
+                fn(conn)
+                conn.execute(insert(SchemaMigration).values(version=version, name=name, applied_at=datetime.now(timezone.utc)))
+                if DEBUG:
+                    print(f"[db] migration {version} {name} applied")
+        _applied_migrations.add(version)
+    _load_applied_migrations(engine)
+
+def _pending_online_migrations(engine) -> list[tuple[int, str, object]]:
+    applied = _load_applied_migrations(engine)
+    return [(v, n, fn) for v, n, fn, online in sorted(MIGRATIONS, key=lambda m: m[0]) if online and v not in applied]
+
+def _apply_online_migrations(engine) -> list[dict]:
+    done: list[dict] = []
+    with engine.connect() as lock_conn:
+        lock_conn = lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        pg = lock_conn.dialect.name == "postgresql"
+        # сессионный lock на отдельном соединении вне транзакции: CONCURRENTLY ждёт
+        # завершения открытых транзакций, в том числе нашей собственной
+        if pg and not lock_conn.exec_driver_sql(f"SELECT pg_try_advisory_lock({ONLINE_MIGRATION_LOCK_ID})").scalar():
+            raise RuntimeError("online migrations are already running in another process")
+        try:
+            for version, name, fn in _pending_online_migrations(engine):
+                started = time.monotonic()
+                fn(engine)
+                with engine.begin() as conn:
+                    conn.execute(insert(SchemaMigration).values(version=version, name=name, applied_at=datetime.now(timezone.utc)))
+                _applied_migrations.add(version)
+                done.append({"version": version, "name": name, "elapsed_s": round(time.monotonic() - started, 3)})
+                if DEBUG:
+                    print(f"[db] online migration {version} {name} applied")
+        finally:
+            if pg:
+                lock_conn.exec_driver_sql(f"SELECT pg_advisory_unlock({ONLINE_MIGRATION_LOCK_ID})")
+    return done
+
+def _create_index_online(engine, name: str, tbl: str, cols: str, where: Optional[str] = None, using: Optional[str] = None) -> None:
+    ddl = f"{name} ON {tbl}" + (f" USING {using}" if using else "") + f" ({cols})" + (f" WHERE {where}" if where else "")
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        if conn.dialect.name != "postgresql":
+            conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {ddl}")
+            return
+        valid = conn.exec_driver_sql(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            f"WHERE c.relname = '{name}'"
+        ).scalar()
+        if valid is False:  # остался от прерванного CREATE INDEX CONCURRENTLY
+            conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        conn.exec_driver_sql(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {ddl}")
+
+def _drop_index_online(engine, name: str) -> None:
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        concurrently = " CONCURRENTLY" if conn.dialect.name == "postgresql" else ""
+        conn.exec_driver_sql(f"DROP INDEX{concurrently} IF EXISTS {name}")
+
+# Full-text search по messages.content: на Postgres — GIN-индекс по выражению
+# to_tsvector (без generated-колонки, т. е. без перезаписи таблицы), на SQLite
+# (локально/тесты) — внешняя FTS5-таблица с триггерами.
+# Конфигурация 'simple': переписка на польском/русском/английском, без стемминга.
+FTS_CONFIG = "simple"
+
+def _fts_document(col: str = "content") -> str:
+    # поиск должен использовать ровно это выражение, иначе планировщик не возьмёт индекс
+    return f"to_tsvector('{FTS_CONFIG}', coalesce({col}, ''))"
+
+@_migration(1, "messages_fulltext", online=True)
+def _m001_messages_fulltext(engine) -> None:
+    if engine.dialect.name == "postgresql":
+        _create_index_online(engine, "ix_messages_content_tsv", "messages", _fts_document(), using="GIN")
+        return
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+            "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"
+        )
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+            "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+        )
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+            "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+        )
+        conn.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN "
+            "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+            "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END"
+        )
+        conn.exec_driver_sql("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+
+# Статистика бесед (messages_count, last_message_at, …) хранится в conversations
+# и обновляется инкрементально в _write_messages; backfill пересчитывает её
+# целиком из messages — для существующих данных и ручной пересинхронизации.
+def _backfill_conversation_stats(conn, id_from: Optional[int] = None, id_to: Optional[int] = None) -> int:
+    def msg_agg(expr, *conds):
+        return (
+            select(expr)
+            .where(Message.conversation_id == Conversation.id, *conds)
+            .correlate(Conversation)
+            .scalar_subquery()
+        )
+
+    stmt = update(Conversation).values(
+        messages_count=func.coalesce(msg_agg(func.count(Message.id)), 0),
+        tool_calls_count=func.coalesce(msg_agg(func.count(Message.id), Message.role == "tool"), 0),
+        last_message_at=func.coalesce(msg_agg(func.max(Message.created_at)), Conversation.created_at),
+        first_user_message_at=msg_agg(func.min(Message.created_at), Message.role == "user"),
+        last_user_message_at=msg_agg(func.max(Message.created_at), Message.role == "user"),
+    )
+    if id_from is not None:
+        stmt = stmt.where(Conversation.id >= id_from)
+    if id_to is not None:
+        stmt = stmt.where(Conversation.id <= id_to)
+    return conn.execute(stmt).rowcount
+
+@_migration(2, "conversation_stats")
+def _m002_conversation_stats(conn) -> None:
+    existing = {c["name"] for c in inspect(conn).get_columns("conversations")}
+    dt_type = DateTime().compile(dialect=conn.dialect)
+    for name, ddl in (
+        ("messages_count", "INTEGER NOT NULL DEFAULT 0"),
+        ("tool_calls_count", "INTEGER NOT NULL DEFAULT 0"),
+        ("last_message_at", dt_type),
+        ("first_user_message_at", dt_type),
+        ("last_user_message_at", dt_type),
+    ):
+        if name not in existing:
+            conn.exec_driver_sql(f"ALTER TABLE conversations ADD COLUMN {name} {ddl}")
+
+# Пересчёт существующих бесед — пачками по id (_backfill_conversation_stats_batched),
+# каждая пачка в своей транзакции; новые сообщения тем временем учитываются
+# инкрементально, пересчёт пачки выставляет абсолютные значения.
+@_migration(5, "conversation_stats_backfill", online=True)
+def _m005_conversation_stats_backfill(engine) -> None:
+    _backfill_conversation_stats_batched(CONVERSATION_STATS_BATCH)
+    _create_index_online(engine, "ix_conversations_messages_count", "conversations", "messages_count, id")
+    _create_index_online(engine, "ix_conversations_last_message_at", "conversations", "last_message_at, id")
+
+# Индексы под реальные пути чтения: история и выгрузки сортируют по
+# (created_at, id), админка фильтрует по role/tool_name/origin/lead_id.
+# (conversation_id, created_at, id) покрывает и прежний ix_messages_conversation_id.
+# Поиск origin по суффиксу (*partner.pl) btree-индекс не использует.
+QUERY_INDEXES = [
+    ("ix_messages_conversation_created", "messages", "conversation_id, created_at, id", None),
+    ("ix_messages_created_at", "messages", "created_at, id", None),
+    ("ix_messages_role_created", "messages", "role, created_at", None),
+    ("ix_messages_tool_name", "messages", "tool_name", "tool_name IS NOT NULL"),
+    ("ix_conversations_created_at", "conversations", "created_at, id", None),
+    ("ix_conversations_origin", "conversations", "origin", None),
+    ("ix_conversations_lead_id", "conversations", "lead_id", "lead_id IS NOT NULL"),
+]
+
+# Новые (пустые) таблицы получают эти индексы сразу в create_all — иначе до
+# `python main.py migrate` каждый запрос истории шёл бы полным сканом.
+# Для существующих таблиц они строятся только online-миграцией 3.
+for _name, _tbl, _cols, _where in QUERY_INDEXES:
+    event.listen(
+        Base.metadata.tables[_tbl], "after_create",
+        DDL(f"CREATE INDEX IF NOT EXISTS {_name} ON {_tbl} ({_cols})" + (f" WHERE {_where}" if _where else "")),
+    )
+
+@_migration(3, "query_indexes", online=True)
+def _m003_query_indexes(engine) -> None:
+    for name, tbl, cols, where in QUERY_INDEXES:
+        _create_index_online(engine, name, tbl, cols, where)
+    # старый индекс удаляется только после того, как новый его покрыл
+    _drop_index_online(engine, "ix_messages_conversation_id")
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            conn.exec_driver_sql("ANALYZE conversations")
+            conn.exec_driver_sql("ANALYZE messages")
+
+# Дедупликация при импорте треда: по id сообщения OpenAI, а для строк без него
+# (записанных чатом или старым импортом) — по md5(role \x1f content).
+def _content_hash(role: str, content: str) -> str:
+    return hashlib.md5(f"{role}\x1f{content}".encode()).hexdigest()
+
+CONTENT_HASH_BACKFILL_BATCH = 5000
+
+@_migration(4, "message_dedup_keys")
+def _m004_message_dedup_keys(conn) -> None:
+    existing = {c["name"] for c in inspect(conn).get_columns("messages")}
+    for name, ddl in (("external_id", "VARCHAR(64)"), ("content_hash", "VARCHAR(32)")):
+        if name not in existing:
+            conn.exec_driver_sql(f"ALTER TABLE messages ADD COLUMN {name} {ddl}")
+
+# content_hash старых строк — пачками по id, каждая пачка в своей транзакции;
+# новые строки получают хэш при записи. Пока backfill не прошёл, импорт считает
+# хэш недостающих строк сам (_import_known_keys).
+@_migration(6, "message_dedup_backfill", online=True)
+def _m006_message_dedup_backfill(engine) -> None:
+    with engine.connect() as conn:
+        lo, hi = conn.execute(
+            select(func.min(Message.id), func.max(Message.id)).where(Message.content_hash.is_(None))
+        ).one()
+    if lo is not None:
+        for start in range(lo, hi + 1, CONTENT_HASH_BACKFILL_BATCH):
+            end = start + CONTENT_HASH_BACKFILL_BATCH - 1
+            with engine.begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    conn.exec_driver_sql(
+                        "UPDATE messages SET content_hash = md5(role || chr(31) || content) "
+                        f"WHERE id BETWEEN {start} AND {end} AND content_hash IS NULL"
+                    )
+                    continue
+                rows = conn.execute(
+                    select(Message.id, Message.role, Message.content)
+                    .where(Message.content_hash.is_(None), Message.id.between(start, end))
+                ).all()
+                if rows:
+                    conn.execute(
+                        update(Message).where(Message.id == bindparam("b_id")).values(content_hash=bindparam("b_hash")),
+                        [{"b_id": r.id, "b_hash": _content_hash(r.role, r.content)} for r in rows],
+                    )
+    _create_index_online(engine, "ix_messages_conversation_external", "messages", "conversation_id, external_id", "external_id IS NOT NULL")
+    _create_index_online(engine, "ix_messages_conversation_hash", "messages", "conversation_id, content_hash")
+
 if engine:
-    try:
-        Base.metadata.create_all(engine)
-        if DEBUG:
-            print("[db] Tables ensured")
-    except Exception as _e:
-        if DEBUG:
-            print(f"[db] init error: {_e}")
+    # без схемы, совпадающей с моделями, воркер запускать нельзя — ошибка останавливает старт
+    Base.metadata.create_all(engine)
+    if DEBUG:
+        print("[db] Tables ensured")
+    _apply_migrations(engine)
+
+# ── Full-text search helpers ───────────────────────────────────────────────
+messages_fts = table("messages_fts", column("rowid"), column("content"))
+
+def _fts_enabled() -> bool:
+    return engine is not None and engine.dialect.name in {"postgresql", "sqlite"} and _migration_applied(1)
+
+def _apply_message_search(q, term: str, *, ranked: bool = False):
+    # returns (query, rank column | None, snippet column | None); без FTS — прежний ILIKE
+    if not _fts_enabled():
+        return q.filter(Message.content.ilike(f"%{term}%")), None, None
+    if engine.dialect.name == "postgresql":
+        tsv = literal_column(_fts_document("messages.content"))
+        tsq = func.websearch_to_tsquery(literal_column(f"'{FTS_CONFIG}'::regconfig"), term)
+        q = q.filter(tsv.op("@@")(tsq))
+        if not ranked:
+            return q, None, None
+        rank = func.ts_rank_cd(tsv, tsq)
+        snippet = func.ts_headline(
+            literal_column(f"'{FTS_CONFIG}'::regconfig"), Message.content, tsq,
+            "StartSel=<mark>, StopSel=</mark>, MaxWords=30, MinWords=10, MaxFragments=2",
+        )
+        return q, rank, snippet
+    # SQLite FTS5: пользовательский ввод → AND из закавыченных токенов (без синтаксиса FTS5)
+    tokens = re.findall(r"\w+", term)
+    if not tokens:
+        return q.filter(Message.content.ilike(f"%{term}%")), None, None
+    match = " ".join('"' + t.replace('"', '""') + '"' for t in tokens)
+    fts = literal_column("messages_fts")
+    q = q.join(messages_fts, messages_fts.c.rowid == Message.id).filter(fts.op("MATCH")(match))
+    if not ranked:
+        return q, None, None
+    # bm25: меньше — релевантнее, инвертируем, чтобы сортировать по убыванию как на Postgres
+    return q, -func.bm25(fts), func.snippet(fts, 0, "<mark>", "</mark>", "…", 16)
 
 # ── CORS ──────────────────────────────────────────────────────────────────
 ALLOWED_ORIGINS = {
@@ -94,27 +483,433 @@ def cors_headers(origin: str) -> dict:
         "Vary": "Origin",
     }
 
-# ── In-memory :  lead_id ↔ thread_id ───────────────────────────────────────
-lead_threads: dict[str, str] = {}
+# ── In-process LRU cache (thread-safe, опциональный TTL) ───────────────────
+_MISSING = object()
+
+class _LRUCache:
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+# ── Metrics (Prometheus text format) ───────────────────────────────────────
+# Свой минимальный реестр без внешних зависимостей: observe — bisect по
+# границам и пара инкрементов под локом, всё остальное (накопительные бакеты,
+# gauge'и пулов/кэшей/очередей) считается только при скрейпе /metrics.
+# METRICS_ENABLED=0 превращает observe в no-op.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") in {"1", "true", "True", "yes", "on"}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRICS: list = []
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_str(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _metric_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class _Timer:
+    __slots__ = ("hist", "labels", "started")
+
+    def __init__(self, hist, labels: tuple):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+class _Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount: float = 1.0) -> None:
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_label_str(self.labels, lv)} {_metric_value(v)}" for lv, v in items]
+
+class _Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # labels → [counts по бакетам (+Inf последним), sum]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values) -> None:
+        if not METRICS_ENABLED:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def time(self, *label_values) -> _Timer:
+        return _Timer(self, label_values)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = [(lv, list(s[0]), s[1]) for lv, s in self._series.items()]
+        lines = []
+        for lv, counts, total in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else _metric_value(bound)
+                le_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_label_str(self.labels, lv, le_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, lv)} {_metric_value(total)}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, lv)} {cumulative}")
+        return lines
+
+CHAT_REQUEST_SECONDS = _Histogram("chat_request_seconds", "End-to-end /chat and /chat/stream latency.", ("endpoint", "outcome"))
+CHAT_STAGE_SECONDS = _Histogram("chat_stage_seconds", "Latency of individual chat pipeline stages.", ("stage",))
+RUN_POLLS = _Histogram("chat_run_polls", "runs.retrieve polls per run, summed over requires_action steps.", (), (1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64))
+RUN_POLL_ERRORS = _Counter("chat_run_poll_errors_total", "Failed runs.retrieve polls.")
+TOOL_CALL_SECONDS = _Histogram("chat_tool_call_seconds", "Tool call duration by function.", ("fn_name", "outcome"))
+BITRIX_CALL_SECONDS = _Histogram("bitrix_call_seconds", "Bitrix24 REST call duration including retries.", ("method", "outcome"))
+DB_WRITE_SECONDS = _Histogram("db_message_write_seconds", "Duration of one message batch write transaction.")
+DB_WRITE_ROWS = _Histogram("db_message_write_rows", "Rows per message batch write.", (), (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
 
 # ── Bitrix24 helpers ───────────────────────────────────────────────────────
-def _bitrix_call(method: str, payload: dict) -> dict:
-    if not BITRIX_WEBHOOK_URL:
-        raise RuntimeError("Bitrix24 webhook URL is not configured. Set BITRIX_WEBHOOK_URL env var.")
-    base = BITRIX_WEBHOOK_URL.rstrip('/')
-    # Accept both base webhook URL and a full method endpoint that already ends with .json
-    if base.endswith('.json'):
-        url = base
-    else:
-        url = f"{base}/{method}.json"
-    resp = requests.post(url, json=payload, timeout=15)
-    resp.raise_for_status()
-    data = resp.json()
-    if isinstance(data, dict) and data.get("error"):
-        raise RuntimeError(f"Bitrix24 error: {data.get('error_description') or data.get('error')}")
-    return data.get("result", data)
-
-def create_bitrix_lead(args: dict) -> int:
+# Async-клиент с keep-alive пулом, ограниченными ретраями (5xx, 429,
+# QUERY_LIMIT_EXCEEDED, сетевые ошибки) и circuit breaker'ом: при падении
+# Bitrix tool-вызовы отказывают сразу, а не держат чат до таймаута run'а.
+# Неидемпотентные методы (crm.lead.add) повторяются только если запрос заведомо
+# не был выполнен: ошибка соединения, 429, QUERY_LIMIT_EXCEEDED. Таймаут чтения
+# или 5xx после отправки мог оставить созданный лид — повтор дал бы дубль.
+BITRIX_TIMEOUT = float(os.getenv("BITRIX_TIMEOUT", "10"))
+BITRIX_CONNECT_TIMEOUT = 5.0
+BITRIX_MAX_RETRIES = int(os.getenv("BITRIX_MAX_RETRIES", "3"))
+BITRIX_RETRY_BACKOFF = float(os.getenv("BITRIX_RETRY_BACKOFF", "0.5"))
+# худший случай одного call(): все попытки до таймаута + максимальный backoff (jitter ×1.5)
+BITRIX_CALL_BUDGET = (
+    (BITRIX_MAX_RETRIES + 1) * (BITRIX_TIMEOUT + BITRIX_CONNECT_TIMEOUT)
+    + BITRIX_RETRY_BACKOFF * 1.5 * (2 ** BITRIX_MAX_RETRIES - 1)
+)
+BITRIX_BREAKER_THRESHOLD = int(os.getenv("BITRIX_BREAKER_THRESHOLD", "5"))
+BITRIX_BREAKER_RESET = float(os.getenv("BITRIX_BREAKER_RESET", "30"))
+BITRIX_RETRY_ERRORS = {"QUERY_LIMIT_EXCEEDED", "INTERNAL_SERVER_ERROR", "OPERATION_TIME_LIMIT"}
+BITRIX_REJECTED_ERRORS = {"QUERY_LIMIT_EXCEEDED"}  # запрос отклонён до выполнения
+# запрос не ушёл на сервер — повтор безопасен для любого метода
+BITRIX_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class BitrixError(RuntimeError):
+    def __init__(self, message: str, *, code: Optional[str] = None, retryable: bool = False, outage: bool = False):
+        super().__init__(message)
+        self.code = code
+        self.retryable = retryable
+        self.outage = outage  # считается ли ошибка отказом сервиса для circuit breaker'а
+
+class CircuitOpenError(BitrixError):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, reset_after: float, probe_timeout: float):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.probe_timeout = probe_timeout
+        self.state = "closed"  # closed | open | half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "half_open" and now - self.probe_at >= self.probe_timeout:
+            # пробный запрос так и не отчитался — снова open, следующий вызов станет новой пробой
+            self.state = "open"
+            self.opened_at = self.probe_at - self.reset_after
+        if self.state == "open" and now - self.opened_at >= self.reset_after:
+            self.state = "half_open"  # пропускаем один пробный запрос
+            self.probe_at = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+class BitrixClient:
+    def __init__(
+        self, webhook_url: Optional[str], *, timeout: float = BITRIX_TIMEOUT, max_retries: int = BITRIX_MAX_RETRIES,
+        breaker: Optional[CircuitBreaker] = None, http: Optional[httpx.AsyncClient] = None,
+    ):
+        self.webhook_url = webhook_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker(BITRIX_BREAKER_THRESHOLD, BITRIX_BREAKER_RESET, BITRIX_CALL_BUDGET)
+        self._http: httpx.AsyncClient | None = http  # http — для тестов (httpx.MockTransport)
+
+    def _url(self, method: str) -> str:
+        base = self.webhook_url.rstrip('/')
+        # Accept both base webhook URL and a full method endpoint that already ends with .json
+        if base.endswith('.json'):
+            return base
+        return f"{base}/{method}.json"
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=BITRIX_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0),
+            )
+        return self._http
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _post(self, method: str, payload: dict, *, idempotent: bool = True):
+        try:
+            resp = await self._client().post(self._url(method), json=payload)
+        except httpx.TransportError as e:
+            retryable = idempotent or isinstance(e, BITRIX_NOT_SENT_ERRORS)
+            raise BitrixError(f"Bitrix24 request failed: {e!r}", retryable=retryable, outage=True)
+        try:
+            data = resp.json()
+        except ValueError:
+            data = None
+        code = data.get("error") if isinstance(data, dict) else None
+        if code or resp.status_code >= 400:
+            description = (data or {}).get("error_description") if isinstance(data, dict) else None
+            rejected = code in BITRIX_REJECTED_ERRORS or resp.status_code == 429
+            failed = code in BITRIX_RETRY_ERRORS or resp.status_code >= 500
+            raise BitrixError(
+                f"Bitrix24 error: {description or code or f'HTTP {resp.status_code}'}",
+                code=code, retryable=rejected or (failed and idempotent),
+                # ошибки бизнес-валидации (4xx с телом Bitrix) — сервис жив, breaker не трогаем
+                outage=rejected or failed or not code,
+            )
+        return data.get("result", data) if isinstance(data, dict) else data
+
+    async def call(self, method: str, payload: dict, *, idempotent: bool = True):
+        if not self.webhook_url:
+            raise RuntimeError("Bitrix24 webhook URL is not configured. Set BITRIX_WEBHOOK_URL env var.")
+        if not self.breaker.allow():
+            BITRIX_CALL_SECONDS.observe(0.0, method, "circuit_open")
+            raise CircuitOpenError("Bitrix24 is unavailable (circuit open), try again later")
+        attempt = 0
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            while True:
+                try:
+                    result = await self._post(method, payload, idempotent=idempotent)
+                except BitrixError as e:
+                    if e.retryable and attempt < self.max_retries:
+                        attempt += 1
+                        await asyncio.sleep(BITRIX_RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+                        continue
+                    if e.outage:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    raise
+                self.breaker.record_success()
+                outcome = "ok"
+                return result
+        except BitrixError:
+            raise
+        except BaseException as e:
+            # отмена (таймаут tool-вызова) или неожиданная ошибка посреди ретраев:
+            # исход неизвестен, и пробный запрос half_open не должен повиснуть навсегда
+            self.breaker.record_failure()
+            if isinstance(e, asyncio.CancelledError):
+                outcome = "cancelled"
+            raise
+        finally:
+            BITRIX_CALL_SECONDS.observe(time.perf_counter() - started, method, outcome)
+
+bitrix = BitrixClient(BITRIX_WEBHOOK_URL)
+
+async def _bitrix_call(method: str, payload: dict) -> dict:
+    return await bitrix.call(method, payload)
+
+# ── Bitrix24: пакетное создание лидов через batch ──────────────────────────
+# Webhook ограничен ~2 запросами/с на портал. Запросы crm.lead.add, пришедшие
+# в пределах короткого окна, уходят одним вызовом batch (до 50 команд), а
+# каждый ID лида возвращается своему ожидающему tool-вызову.
+BITRIX_BATCH_WINDOW = float(os.getenv("BITRIX_BATCH_WINDOW_MS", "50")) / 1000
+BITRIX_BATCH_MAX = 50  # лимит команд в одном batch у Bitrix24
+
+def _bitrix_query(params: dict) -> str:
+    # PHP-style http_build_query: fields[PHONE][0][VALUE]=...
+    parts: list[str] = []
+
+    def walk(value, key: str) -> None:
+        if isinstance(value, dict):
+            for k, v in value.items():
+                walk(v, f"{key}[{k}]")
+        elif isinstance(value, (list, tuple)):
+            for i, v in enumerate(value):
+                walk(v, f"{key}[{i}]")
+        elif value is not None:
+            parts.append(f"{quote(key, safe='[]')}={quote(str(value), safe='')}")
+
+    for k, v in params.items():
+        walk(v, str(k))
+    return "&".join(parts)
+
+class LeadBatcher:
+    def __init__(self, bitrix_client: BitrixClient, *, window: float = BITRIX_BATCH_WINDOW, max_size: int = BITRIX_BATCH_MAX):
+        self.bitrix = bitrix_client
+        self.window = window
+        self.max_size = max_size
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._sending: set[asyncio.Task] = set()  # сильные ссылки: таск не соберёт GC посреди отправки
+        self.batches = 0
+        self.batched_leads = 0
+
+    @property
+    def enabled(self) -> bool:
+        # полный URL метода (…/crm.lead.add.json) не умеет batch
+        url = (self.bitrix.webhook_url or "").rstrip('/')
+        return self.window > 0 and bool(url) and not url.endswith('.json')
+
+    async def add(self, payload: dict):
+        if not self.enabled:
+            return await self.bitrix.call("crm.lead.add", payload, idempotent=False)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((payload, fut))
+        if len(self._pending) >= self.max_size:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._dispatch)
+        return await fut
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_size], self._pending[self.max_size:]
+            task = asyncio.get_running_loop().create_task(self._send(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, batch: list[tuple[dict, asyncio.Future]]) -> None:
+        if len(batch) == 1:
+            payload, fut = batch[0]
+            try:
+                result = await self.bitrix.call("crm.lead.add", payload, idempotent=False)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+                return
+            if not fut.done():
+                fut.set_result(result)
+            return
+
+        cmd = {f"l{i}": "crm.lead.add?" + _bitrix_query(payload) for i, (payload, _) in enumerate(batch)}
+        try:
+            # batch из crm.lead.add так же неидемпотентен: повтор после таймаута дублирует все лиды
+            result = await self.bitrix.call("batch", {"halt": 0, "cmd": cmd}, idempotent=False)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.batches += 1
+        self.batched_leads += len(batch)
+        results = result.get("result") if isinstance(result, dict) else None
+        errors = result.get("result_error") if isinstance(result, dict) else None
+        results = results if isinstance(results, dict) else {}
+        errors = errors if isinstance(errors, dict) else {}  # пустой PHP-массив приходит как []
+        for i, (_, fut) in enumerate(batch):
+            if fut.done():
+                continue
+            key = f"l{i}"
+            if results.get(key) not in (None, False):
+                fut.set_result(results[key])
+            else:
+                err = errors.get(key) or {}
+                fut.set_exception(BitrixError(
+                    f"Bitrix24 error: {err.get('error_description') or err.get('error') or 'no result in batch'}",
+                    code=err.get("error"),
+                ))
+
+lead_batcher = LeadBatcher(bitrix)
+
+async def create_bitrix_lead(args: dict) -> int:
     title = args.get("title") or args.get("deal_title") or "Website Chat Lead"
     first_name = args.get("first_name") or args.get("name") or ""
     last_name = args.get("last_name") or args.get("surname") or ""
@@ -141,24 +936,215 @@ def create_bitrix_lead(args: dict) -> int:
     if assigned_by_id:
         fields["ASSIGNED_BY_ID"] = assigned_by_id
 
-    result = _bitrix_call("crm.lead.add", {"fields": fields, "params": {"REGISTER_SONET_EVENT": "Y"}})
+    result = await lead_batcher.add({"fields": fields, "params": {"REGISTER_SONET_EVENT": "Y"}})
     if isinstance(result, int):
         return result
     # sometimes Bitrix returns {"result": <id>} handled in _bitrix_call, but keep a safeguard
     return int(result)
 
-def _extract_last_text_message(client: OpenAI, thread_id: str) -> str:
-    messages = client.beta.threads.messages.list(thread_id, order="desc")
+def _message_text(message) -> str:
+    for part in getattr(message, "content", None) or []:
+        if getattr(part, "type", None) == "text" and getattr(part, "text", None):
+            text_value = getattr(part.text, "value", None)
+            if isinstance(text_value, str) and text_value.strip():
+                return text_value
+    return ""
+
+async def _extract_last_text_message(client: AsyncOpenAI, thread_id: str) -> str:
+    messages = await client.beta.threads.messages.list(thread_id, order="desc")
     for message in messages.data:
         if getattr(message, "role", None) != "assistant":
             continue
-        for part in getattr(message, "content", []):
-            if getattr(part, "type", None) == "text" and getattr(part, "text", None):
-                text_value = getattr(part.text, "value", None)
-                if isinstance(text_value, str) and text_value.strip():
-                    return text_value
+        text_value = _message_text(message)
+        if text_value:
+            return text_value
     return ""
 
+# ── Run watcher: общий поллер статусов assistant-run'ов ─────────────────────
+# Вместо отдельного цикла «retrieve + sleep(1)» в каждом запросе чаты
+# регистрируют (thread_id, run_id) и ждут future. Один фоновый таск на воркер
+# опрашивает все активные run'ы: сначала часто, затем с экспоненциальным
+# backoff + jitter; run'ы, ставшие «due» в одном тике, опрашиваются пачкой,
+# повторная регистрация того же run'а не порождает лишних запросов.
+# Каждый опрос — отдельный таск: медленный retrieve одного run'а не задерживает
+# опросы и дедлайны остальных. RUN_POLLS наблюдается один раз на run — в
+# конечном статусе (или по таймауту/ошибкам); опросы до requires_action
+# копятся в _carried и прибавляются к следующей регистрации того же run'а.
+RUN_TIMEOUT = float(os.getenv("RUN_TIMEOUT", "90"))
+RUN_POLL_INITIAL = float(os.getenv("RUN_POLL_INITIAL", "0.25"))
+RUN_POLL_MAX = float(os.getenv("RUN_POLL_MAX", "3"))
+RUN_POLL_FACTOR = 1.6
+RUN_POLL_JITTER = 0.2
+RUN_POLL_TICK = 0.05           # due-моменты выравниваются по тику, чтобы опросы склеивались
+RUN_POLL_CONCURRENCY = int(os.getenv("RUN_POLL_CONCURRENCY", "16"))
+RUN_POLL_MAX_ERRORS = 3
+RUN_PENDING_STATUSES = {"queued", "in_progress", "cancelling"}
+RUN_POLL_CARRY_SIZE = 10000
+
+class _WatchedRun:
+    __slots__ = ("thread_id", "run_id", "deadline", "interval", "next_poll", "polls", "errors", "waiters")
+
+    def __init__(self, thread_id: str, run_id: str, deadline: float):
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.deadline = deadline
+        self.interval = RUN_POLL_INITIAL
+        self.next_poll = time.time() + RUN_POLL_INITIAL
+        self.polls = 0
+        self.errors = 0
+        self.waiters: list[asyncio.Future] = []
+
+class RunWatcher:
+    def __init__(self):
+        self._runs: dict[tuple[str, str], _WatchedRun] = {}
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._sem: asyncio.Semaphore | None = None
+        self._polling: set[asyncio.Task] = set()
+        # (thread_id, run_id) → опросы прошлых шагов, закончившихся requires_action
+        self._carried = _LRUCache(RUN_POLL_CARRY_SIZE, ttl=RUN_TIMEOUT * 4)
+
+    @property
+    def inflight(self) -> int:
+        return len(self._runs)
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._sem = asyncio.Semaphore(RUN_POLL_CONCURRENCY)
+            self._task = asyncio.create_task(self._loop())
+
+    async def wait(self, thread_id: str, run_id: str, *, deadline: float):
+        self._ensure_started()
+        key = (thread_id, run_id)
+        entry = self._runs.get(key)
+        if entry is None:
+            entry = _WatchedRun(thread_id, run_id, deadline)
+            self._runs[key] = entry
+        else:
+            entry.deadline = max(entry.deadline, deadline)
+        fut = asyncio.get_running_loop().create_future()
+        entry.waiters.append(fut)
+        self._wakeup.set()
+        try:
+            return await fut
+        finally:
+            if fut in entry.waiters:
+                entry.waiters.remove(fut)
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        polling, self._polling = self._polling, set()
+        for t in polling:
+            t.cancel()
+        if polling:
+            await asyncio.gather(*polling, return_exceptions=True)
+        for entry in self._runs.values():
+            self._resolve(entry, exc=RuntimeError("run watcher stopped"))
+        self._runs.clear()
+
+    @staticmethod
+    def _resolve(entry: _WatchedRun, *, result=None, exc: Exception | None = None) -> None:
+        for fut in entry.waiters:
+            if fut.done():
+                continue
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(result)
+
+    def _forget(self, entry: _WatchedRun) -> bool:
+        # за время опроса run мог снять дедлайн (он уже учтён в RUN_POLLS) или
+        # зарегистрироваться заново; True — запись убрали именно здесь
+        key = (entry.thread_id, entry.run_id)
+        if self._runs.get(key) is entry:
+            del self._runs[key]
+            return True
+        return False
+
+    def _observe(self, entry: _WatchedRun, status: Optional[str] = None) -> None:
+        key = (entry.thread_id, entry.run_id)
+        polls = self._carried.pop(key, 0) + entry.polls
+        if status == "requires_action":
+            self._carried.set(key, polls)  # run продолжится после submit_tool_outputs
+        else:
+            RUN_POLLS.observe(polls)
+
+    async def _poll(self, entry: _WatchedRun) -> None:
+        try:
+            await self._poll_once(entry)
+        finally:
+            if self._wakeup is not None:
+                self._wakeup.set()  # пересчитать ближайший due-момент
+
+    async def _poll_once(self, entry: _WatchedRun) -> None:
+        async with self._sem:
+            try:
+                run_status = await client.beta.threads.runs.retrieve(
+                    run_id=entry.run_id,
+                    thread_id=entry.thread_id
+                )
+            except Exception as e:
+                entry.errors += 1
+                RUN_POLL_ERRORS.inc()
+                if entry.errors >= RUN_POLL_MAX_ERRORS:
+                    if self._forget(entry):
+                        self._observe(entry)
+                    self._resolve(entry, exc=e)
+                    return
+                run_status = None
+        entry.polls += 1
+        if DEBUG and run_status is not None:
+            print(f"[runs] {entry.run_id} status={run_status.status} polls={entry.polls}")
+        if run_status is not None and run_status.status not in RUN_PENDING_STATUSES:
+            if self._forget(entry):
+                self._observe(entry, run_status.status)
+            self._resolve(entry, result=run_status)
+            return
+        # exponential backoff + jitter, не дальше дедлайна
+        entry.interval = min(RUN_POLL_MAX, entry.interval * RUN_POLL_FACTOR)
+        delay = entry.interval * random.uniform(1 - RUN_POLL_JITTER, 1 + RUN_POLL_JITTER)
+        entry.next_poll = min(time.time() + delay, entry.deadline)
+
+    async def _loop(self) -> None:
+        while True:
+            now = time.time()
+            due: list[_WatchedRun] = []
+            for key, entry in list(self._runs.items()):
+                if not any(not f.done() for f in entry.waiters):
+                    self._runs.pop(key, None)  # все ожидающие ушли (отмена запроса)
+                    self._carried.pop(key, None)
+                elif now >= entry.deadline:
+                    self._runs.pop(key, None)
+                    self._observe(entry)
+                    self._resolve(entry, exc=TimeoutError("Assistant run timeout"))
+                elif entry.next_poll <= now + RUN_POLL_TICK:
+                    entry.next_poll = float("inf")  # опрос уже в полёте
+                    due.append(entry)
+            for entry in due:
+                task = asyncio.create_task(self._poll(entry))
+                self._polling.add(task)
+                task.add_done_callback(self._polling.discard)
+
+            self._wakeup.clear()
+            if self._runs:
+                next_at = min(min(e.next_poll, e.deadline) for e in self._runs.values())
+                timeout = max(RUN_POLL_TICK, next_at - time.time())
+            else:
+                timeout = None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+run_watcher = RunWatcher()
+
 # ── DB helpers ─────────────────────────────────────────────────────────────
 
 def _db_session():
@@ -166,40 +1152,510 @@ def _db_session():
         return None
     return SessionLocal()
 
-def _get_or_create_conversation(session, thread_id: str, origin: Optional[str], lead_id: Optional[int] = None) -> Conversation:
-    conv = session.query(Conversation).filter_by(thread_id=thread_id).one_or_none()
-    if conv is None:
-        conv = Conversation(thread_id=thread_id, origin=origin, lead_id=lead_id)
-        session.add(conv)
-        session.commit()
-        session.refresh(conv)
+# thread_id → (conversation_id, lead_id уже проставлен). Заполняется только после commit,
+# сбрасывается при ошибке записи — в кэше не бывает id несуществующих строк.
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+_conversation_cache = _LRUCache(CONVERSATION_CACHE_SIZE)
+
+def _upsert_insert(session):
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    return dialect_insert
+
+def _get_or_create_conversation(session, thread_id: str, origin: Optional[str], lead_id: Optional[int] = None, created_at: Optional[datetime] = None) -> tuple[int, bool]:
+    # returns (conversation_id, lead_id is set)
+    cached = _conversation_cache.get(thread_id)
+    if cached is not None:
+        conv_id, has_lead = cached
     else:
-        if lead_id is not None and conv.lead_id is None:
-            conv.lead_id = lead_id
-            session.commit()
-    return conv
+        conv_id = None
+        created_at = created_at or datetime.now(timezone.utc)
+        dialect_insert = _upsert_insert(session)
+        if dialect_insert is not None:
+            # атомарный upsert: конкурентные запросы по новому thread_id не падают на unique
+            stmt = (
+                dialect_insert(Conversation)
+                .values(thread_id=thread_id, origin=origin, lead_id=lead_id, created_at=created_at, last_message_at=created_at)
+                .on_conflict_do_nothing(index_elements=["thread_id"])
+                .returning(Conversation.id)
+            )
+            conv_id = session.execute(stmt).scalar()
+            if conv_id is not None:
+                return conv_id, lead_id is not None
+        row = session.execute(
+            select(Conversation.id, Conversation.lead_id).where(Conversation.thread_id == thread_id)
+        ).first()
+        if row is None:
+            conv = Conversation(thread_id=thread_id, origin=origin, lead_id=lead_id, created_at=created_at, last_message_at=created_at)
+            session.add(conv)
+            session.flush()
+            return conv.id, lead_id is not None
+        conv_id, has_lead = row[0], row[1] is not None
+    if lead_id is not None and not has_lead:
+        session.execute(
+            update(Conversation)
+            .where(Conversation.id == conv_id, Conversation.lead_id.is_(None))
+            .values(lead_id=lead_id)
+        )
+        has_lead = True
+    return conv_id, has_lead
+
+def _message_record(thread_id: str, origin: Optional[str], role: str, content: str, *, tool_name: Optional[str] = None, tool_args: Optional[dict] = None, lead_id: Optional[int] = None, external_id: Optional[str] = None, created_at: Optional[datetime] = None) -> dict:
+    return {
+        "thread_id": thread_id,
+        "origin": origin,
+        "role": role,
+        "content": content or "",
+        "tool_name": tool_name,
+        "tool_args": tool_args,
+        "lead_id": lead_id,
+        "external_id": external_id,
+        # время фиксируем в момент вызова, а не записи — порядок в истории не зависит от очереди
+        "created_at": created_at or datetime.now(timezone.utc),
+    }
+
+def _later(col, value):
+    # col := max(col, value) с учётом NULL; портабельно (без GREATEST)
+    return case((or_(col.is_(None), col < value), value), else_=col)
+
+def _earlier(col, value):
+    return case((or_(col.is_(None), col > value), value), else_=col)
+
+def _bump_conversation_stats(session, records: list[dict], convs: dict[str, tuple[int, bool]]) -> None:
+    per_conv: dict[int, dict] = {}
+    for rec in records:
+        st = per_conv.setdefault(convs[rec["thread_id"]][0], {"n": 0, "tools": 0, "last": None, "first_user": None, "last_user": None})
+        ts = rec["created_at"]
+        if ts.tzinfo is not None:  # колонки без tz; сравниваем наивные UTC
+            ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+        st["n"] += 1
+        if rec["role"] == "tool":
+            st["tools"] += 1
+        st["last"] = ts if st["last"] is None else max(st["last"], ts)
+        if rec["role"] == "user":
+            st["first_user"] = ts if st["first_user"] is None else min(st["first_user"], ts)
+            st["last_user"] = ts if st["last_user"] is None else max(st["last_user"], ts)
+    for conv_id, st in per_conv.items():
+        values = {
+            "messages_count": Conversation.messages_count + st["n"],
+            "last_message_at": _later(Conversation.last_message_at, st["last"]),
+        }
+        if st["tools"]:
+            values["tool_calls_count"] = Conversation.tool_calls_count + st["tools"]
+        if st["first_user"] is not None:
+            values["first_user_message_at"] = _earlier(Conversation.first_user_message_at, st["first_user"])
+            values["last_user_message_at"] = _later(Conversation.last_user_message_at, st["last_user"])
+        session.execute(update(Conversation).where(Conversation.id == conv_id).values(**values))
+
+def _write_messages(session, records: list[dict]) -> None:
+    # Один multi-row INSERT на пачку; беседы резолвятся по одному разу на thread_id.
+    convs: dict[str, tuple[int, bool]] = {}
+    started = time.perf_counter()
+    try:
+        for rec in records:
+            tid = rec["thread_id"]
+            if tid not in convs or (rec["lead_id"] is not None and not convs[tid][1]):
+                convs[tid] = _get_or_create_conversation(session, tid, rec["origin"], rec["lead_id"], rec["created_at"])
+        session.execute(insert(Message), [
+            {
+                "conversation_id": convs[rec["thread_id"]][0],
+                "role": rec["role"],
+                "content": rec["content"],
+                "tool_name": rec["tool_name"],
+                "tool_args": rec["tool_args"],
+                "created_at": rec["created_at"],
+                "external_id": rec["external_id"],
+                "content_hash": _content_hash(rec["role"], rec["content"]),
+            }
+            for rec in records
+        ])
+        _bump_conversation_stats(session, records, convs)
+        session.commit()
+    except Exception:
+        for rec in records:
+            _conversation_cache.pop(rec["thread_id"])
+        raise
+    for tid, value in convs.items():
+        _conversation_cache.set(tid, value)
+    DB_WRITE_SECONDS.observe(time.perf_counter() - started)
+    DB_WRITE_ROWS.observe(len(records))
+
+def _write_record(record: dict) -> None:
+    session = _db_session()
+    try:
+        _write_messages(session, [record])
+    except Exception as e:
+        session.rollback()
+        if DEBUG:
+            print(f"[db] save_message error: {e}")
+    finally:
+        session.close()
+
+async def _save_message(thread_id: str, origin: Optional[str], role: str, content: str, *, tool_name: Optional[str] = None, tool_args: Optional[dict] = None, lead_id: Optional[int] = None) -> None:
+    if not SessionLocal:
+        return
+    record = _message_record(thread_id, origin, role, content, tool_name=tool_name, tool_args=tool_args, lead_id=lead_id)
+    if message_writer.submit(record):
+        return
+    # writer не запущен или очередь переполнена — пишем напрямую, но не в event loop
+    await asyncio.to_thread(_write_record, record)
+
+# ── Write-behind: фоновая пакетная запись сообщений ───────────────────────
+# _save_message кладёт запись в ограниченную очередь; отдельный поток сбрасывает
+# её пачками (одна транзакция, multi-row INSERT) по размеру или по таймеру.
+# Если пачка не записалась, записи пишутся по одной: сбойные возвращаются в
+# следующую пачку, а после MESSAGE_WRITE_ATTEMPTS попыток уходят в dead-letter.
+MESSAGE_QUEUE_MAX = int(os.getenv("MESSAGE_QUEUE_MAX", "10000"))
+MESSAGE_FLUSH_SIZE = int(os.getenv("MESSAGE_FLUSH_SIZE", "200"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.5"))
+MESSAGE_WRITE_ATTEMPTS = int(os.getenv("MESSAGE_WRITE_ATTEMPTS", "3"))
+MESSAGE_DEAD_LETTER_MAX = int(os.getenv("MESSAGE_DEAD_LETTER_MAX", "1000"))
+
+class MessageWriter:
+    _STOP = object()
+
+    def __init__(self):
+        self._q: queue.Queue = queue.Queue(maxsize=MESSAGE_QUEUE_MAX)
+        self._thread: threading.Thread | None = None
+        self._retry: list[dict] = []
+        self.dead_letters: deque = deque(maxlen=MESSAGE_DEAD_LETTER_MAX)
+        self.enqueued = 0
+        self.overflow = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.retried = 0
+        self.failed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
 
-def _save_message(thread_id: str, origin: Optional[str], role: str, content: str, *, tool_name: Optional[str] = None, tool_args: Optional[dict] = None, lead_id: Optional[int] = None) -> None:
+    def start(self) -> None:
+        if not SessionLocal or self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        # дренаж: всё, что уже в очереди, будет записано до выхода потока
+        if not self.running:
+            return
+        self._q.put(self._STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, record: dict) -> bool:
+        if not self.running:
+            return False
+        try:
+            self._q.put_nowait(record)
+        except queue.Full:
+            self.overflow += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queue_depth": self._q.qsize(),
+            "queue_max": MESSAGE_QUEUE_MAX,
+            "enqueued": self.enqueued,
+            "overflow": self.overflow,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "retried": self.retried,
+            "retry_pending": len(self._retry),
+            "failed": self.failed,
+            "dead_letters": len(self.dead_letters),
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+        }
+
+    def _run(self) -> None:
+        batch: list[dict] = []
+        flush_at = 0.0
+        while True:
+            timeout = max(0.0, flush_at - time.monotonic()) if batch else None
+            try:
+                item = self._q.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self._STOP:
+                while batch:
+                    self._flush(batch)
+                    batch, self._retry = self._retry, []
+                return
+            if item is not None:
+                if not batch:
+                    flush_at = time.monotonic() + MESSAGE_FLUSH_INTERVAL
+                batch.append(item)
+            if batch and (len(batch) >= MESSAGE_FLUSH_SIZE or time.monotonic() >= flush_at):
+                self._flush(batch)
+                batch, self._retry = self._retry, []
+                flush_at = time.monotonic() + MESSAGE_FLUSH_INTERVAL
+
+    def _flush(self, batch: list[dict]) -> None:
+        started = time.perf_counter()
+        session = _db_session()
+        try:
+            _write_messages(session, batch)
+            self.flushed += len(batch)
+            ok = True
+        except Exception as e:
+            session.rollback()
+            ok = False
+            if DEBUG:
+                print(f"[db] flush error ({len(batch)} messages): {e}")
+        finally:
+            session.close()
+        if not ok:
+            self._flush_each(batch)
+        elapsed = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self.last_flush_ms = elapsed
+        self.total_flush_ms += elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+
+    def _flush_each(self, batch: list[dict]) -> None:
+        # одна битая запись (или чужая беседа) не должна утянуть за собой всю пачку
+        for rec in batch:
+            session = _db_session()
+            try:
+                _write_messages(session, [rec])
+                self.flushed += 1
+            except Exception as e:
+                session.rollback()
+                rec["attempts"] = rec.get("attempts", 0) + 1
+                if rec["attempts"] < MESSAGE_WRITE_ATTEMPTS:
+                    self.retried += 1
+                    self._retry.append(rec)
+                else:
+                    self.failed += 1
+                    self.dead_letters.append({**rec, "error": str(e)})
+                    if DEBUG:
+                        print(f"[db] message dead-lettered after {rec['attempts']} attempts: {e}")
+            finally:
+                session.close()
+
+    def requeue_dead_letters(self) -> int:
+        requeued = 0
+        while self.dead_letters:
+            rec = self.dead_letters.popleft()
+            rec.pop("error", None)
+            rec["attempts"] = 0
+            if not self.submit(rec):
+                rec["error"] = "requeue failed: writer not running or queue full"
+                self.dead_letters.appendleft(rec)
+                break
+            self.failed -= 1
+            requeued += 1
+        return requeued
+
+message_writer = MessageWriter()
+
+def _ensure_conversation(thread_id: str, origin: Optional[str], lead_id: Optional[int] = None) -> None:
+    # синхронная (не write-behind) запись беседы — когда её должны сразу видеть другие воркеры
     session = _db_session()
     if not session:
         return
     try:
         conv = _get_or_create_conversation(session, thread_id, origin, lead_id)
-        msg = Message(
-            conversation_id=conv.id,
-            role=role,
-            content=content or "",
-            tool_name=tool_name,
-            tool_args=tool_args,
-        )
-        session.add(msg)
         session.commit()
+        _conversation_cache.set(thread_id, conv)
     except Exception as e:
+        session.rollback()
+        _conversation_cache.pop(thread_id)
         if DEBUG:
-            print(f"[db] save_message error: {e}")
+            print(f"[db] ensure_conversation error: {e}")
     finally:
         session.close()
 
+# ── lead_id ↔ thread_id ────────────────────────────────────────────────────
+# Источник правды — таблица conversations (lead_id, thread_id): маппинг переживает
+# рестарты и общий для всех воркеров. Перед ней — in-process LRU с TTL.
+# Нечисловые lead_id в Integer-колонку не ложатся и живут только в кэше.
+LEAD_THREAD_CACHE_SIZE = int(os.getenv("LEAD_THREAD_CACHE_SIZE", "10000"))
+LEAD_THREAD_CACHE_TTL = float(os.getenv("LEAD_THREAD_CACHE_TTL", "3600"))
+
+def _lead_int(lead_id: Optional[str]) -> Optional[int]:
+    try:
+        return int(str(lead_id).strip())
+    except (TypeError, ValueError):
+        return None
+
+class LeadThreadStore:
+    def __init__(self):
+        self._cache = _LRUCache(LEAD_THREAD_CACHE_SIZE, ttl=LEAD_THREAD_CACHE_TTL)
+
+    async def get(self, lead_id: str) -> Optional[str]:
+        thread_id = self._cache.get(lead_id)
+        if thread_id is None and SessionLocal and _lead_int(lead_id) is not None:
+            thread_id = await asyncio.to_thread(self._load, _lead_int(lead_id))
+            if thread_id:
+                self._cache.set(lead_id, thread_id)
+        return thread_id
+
+    async def set(self, lead_id: str, thread_id: str, origin: Optional[str] = None) -> None:
+        self._cache.set(lead_id, thread_id)
+        lead_val = _lead_int(lead_id)
+        if lead_val is not None and SessionLocal:
+            await asyncio.to_thread(_ensure_conversation, thread_id, origin, lead_val)
+
+    @staticmethod
+    def _load(lead_id: int) -> Optional[str]:
+        session = _db_session()
+        try:
+            return session.execute(
+                select(Conversation.thread_id)
+                .where(Conversation.lead_id == lead_id)
+                .order_by(Conversation.created_at.desc(), Conversation.id.desc())
+                .limit(1)
+            ).scalar()
+        except Exception as e:
+            if DEBUG:
+                print(f"[db] lead thread lookup error: {e}")
+            return None
+        finally:
+            session.close()
+
+lead_threads = LeadThreadStore()
+
+# ── Pre-warmed OpenAI threads ──────────────────────────────────────────────
+# Пустые треды создаются заранее в фоне, чтобы первый ответ новому посетителю
+# не ждал threads.create. Пул держит THREAD_POOL_SIZE готовых тредов,
+# добирает их после каждой выдачи и не отдаёт треды старше THREAD_POOL_TTL.
+# Пул пуст (или выключен, THREAD_POOL_SIZE=0) — тред создаётся как раньше.
+# Просроченные и оставшиеся при остановке треды удаляются в OpenAI
+# (best-effort, не дольше THREAD_POOL_DELETE_TIMEOUT), чтобы не копить сирот.
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "4"))
+THREAD_POOL_TTL = float(os.getenv("THREAD_POOL_TTL", "3600"))
+THREAD_POOL_REFILL_CONCURRENCY = int(os.getenv("THREAD_POOL_REFILL_CONCURRENCY", "2"))
+THREAD_POOL_RETRY_MAX = 30.0
+THREAD_POOL_DELETE_TIMEOUT = float(os.getenv("THREAD_POOL_DELETE_TIMEOUT", "5"))
+
+class WarmThreadPool:
+    def __init__(self, size: int = THREAD_POOL_SIZE, ttl: float = THREAD_POOL_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._ready: deque[tuple[str, float]] = deque()  # (thread_id, created_at monotonic)
+        self._doomed: list[str] = []  # просрочены, ещё не удалены в OpenAI
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._hits = self._misses = self._expired = self._created = self._errors = 0
+        self._deleted = self._delete_errors = 0
+
+    def start(self) -> None:
+        if self.size > 0 and (self._task is None or self._task.done()):
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._doomed.extend(thread_id for thread_id, _ in self._ready)
+        self._ready.clear()
+        await self._delete_doomed()
+
+    def _drop_expired(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        while self._ready and self._ready[0][1] < cutoff:
+            self._doomed.append(self._ready.popleft()[0])
+            self._expired += 1
+
+    async def _delete_one(self, thread_id: str) -> None:
+        try:
+            await asyncio.wait_for(client.beta.threads.delete(thread_id), THREAD_POOL_DELETE_TIMEOUT)
+            self._deleted += 1
+        except Exception as e:
+            self._delete_errors += 1
+            if DEBUG:
+                print(f"[thread-pool] delete {thread_id} error: {e}")
+        # при отмене тред остаётся в _doomed — его доудалит stop()
+        self._doomed.remove(thread_id)
+
+    async def _delete_doomed(self) -> None:
+        if self._doomed:
+            await asyncio.gather(*(self._delete_one(thread_id) for thread_id in list(self._doomed)))
+
+    def take(self) -> Optional[str]:
+        """Готовый тред или None (тогда вызывающий создаёт тред сам)."""
+        if self.size <= 0:
+            return None
+        self._drop_expired()
+        thread_id = None
+        if self._ready:
+            thread_id = self._ready.popleft()[0]
+            self._hits += 1
+        else:
+            self._misses += 1
+        self.start()
+        self._wakeup.set()
+        return thread_id
+
+    async def _create_one(self) -> None:
+        thread = await client.beta.threads.create()
+        self._ready.append((thread.id, time.monotonic()))
+        self._created += 1
+
+    async def _loop(self) -> None:
+        delay = 1.0
+        while True:
+            self._drop_expired()
+            await self._delete_doomed()
+            missing = self.size - len(self._ready)
+            if missing > 0:
+                results = await asyncio.gather(
+                    *(self._create_one() for _ in range(min(missing, THREAD_POOL_REFILL_CONCURRENCY))),
+                    return_exceptions=True,
+                )
+                failures = [r for r in results if isinstance(r, Exception)]
+                if not failures:
+                    delay = 1.0
+                    continue
+                self._errors += len(failures)
+                if DEBUG:
+                    print(f"[thread-pool] refill error: {failures[0]}")
+                await asyncio.sleep(delay * (1 + random.random() * 0.2))
+                delay = min(THREAD_POOL_RETRY_MAX, delay * 2)
+                continue
+            # полон: спим до следующей выдачи или до истечения самого старого треда
+            self._wakeup.clear()
+            timeout = max(1.0, self._ready[0][1] + self.ttl - time.monotonic()) if self._ready else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "target": self.size,
+            "ready": len(self._ready),
+            "hits": self._hits,
+            "misses": self._misses,
+            "expired": self._expired,
+            "created": self._created,
+            "errors": self._errors,
+            "deleted": self._deleted,
+            "delete_errors": self._delete_errors,
+        }
+
+warm_threads = WarmThreadPool()
+
 def _parse_bool(value: Optional[str]) -> Optional[bool]:
     if value is None:
         return None
@@ -221,117 +1677,450 @@ def _parse_dt(value: Optional[str]) -> Optional[datetime]:
     except Exception:
         return None
 
-# ── Модель входящего запроса ──────────────────────────────────────────────
-class ChatRequest(BaseModel):
+# Opaque keyset-курсор: urlsafe base64 от JSON-списка значений ключа сортировки.
+def _encode_cursor(values: list) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).rstrip(b"=").decode()
+
+def _decode_cursor(token: Optional[str]) -> Optional[list]:
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+    except Exception:
+        return None
+    return values if isinstance(values, list) else None
+
+def _message_cursor(m) -> str:
+    return _encode_cursor([m.created_at, m.id])
+
+def _decode_message_cursor(token: Optional[str]) -> Optional[tuple[datetime, int]]:
+    values = _decode_cursor(token)
+    try:
+        return datetime.fromisoformat(values[0]), int(values[1])
+    except Exception:
+        return None
+
+# курсоры истории, прочитанной из OpenAI, — id сообщения треда
+def _openai_cursor(message_id: Optional[str]) -> Optional[str]:
+    return _encode_cursor(["openai", message_id]) if message_id else None
+
+def _decode_openai_cursor(token: Optional[str]) -> Optional[str]:
+    values = _decode_cursor(token)
+    if values and len(values) == 2 and values[0] == "openai" and isinstance(values[1], str):
+        return values[1]
+    return None
+
+# ── Модель входящего запроса ──────────────────────────────────────────────
+class ChatRequest(BaseModel):
     message: str
     lead_id: str | None = None          # используйте, если нужно «склеивать» диалог
     thread_id: str | None = Field(default=None, alias="threadId")  # поддерживаем snakeCase и camelCase
 
+# ── Chat pipeline helpers ─────────────────────────────────────────────────
+async def _resolve_thread_id(req: ChatRequest, request: Request) -> tuple[str, bool]:
+    """(thread_id, создан ли тред только что — т.е. это первое сообщение беседы)"""
+    # Попытка извлечь thread_id/threadId напрямую из тела запроса для максимальной совместимости
+    body_thread_id = None
+    try:
+        body = await request.json()
+        if isinstance(body, dict):
+            body_thread_id = body.get("thread_id") or body.get("threadId")
+    except Exception:
+        body_thread_id = None
+
+    thread_id = req.thread_id or body_thread_id or (await lead_threads.get(req.lead_id) if req.lead_id else None)
+    new_thread = not thread_id
+    if new_thread:
+        thread_id = warm_threads.take()
+        if thread_id is None:
+            with CHAT_STAGE_SECONDS.time("thread_create"):
+                thread_id = (await client.beta.threads.create()).id
+        if req.lead_id:
+            await lead_threads.set(req.lead_id, thread_id, request.headers.get("origin", ""))
+    if DEBUG:
+        print(f"[chat] thread_id={thread_id} (in={req.thread_id} body_in={body_thread_id})")
+    return thread_id, new_thread
+
+async def _post_user_message(thread_id: str, origin: str, text: str) -> None:
+    with CHAT_STAGE_SECONDS.time("post_user_message"):
+        await client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="user",
+            content=text
+        )
+    # Persist user message
+    try:
+        await _save_message(thread_id, origin, role="user", content=text)
+    except Exception:
+        pass
+
+# ── Opening-turn answer cache ──────────────────────────────────────────────
+# Первые сообщения часто повторяются («сколько стоит регистрация спółki»).
+# Ответ run'а на первое сообщение нового треда кэшируется по
+# (нормализованный текст, origin, ASSISTANT_ID) — только если run обошёлся без
+# tool calls (ответ не зависит от побочных эффектов вроде лида). При попадании
+# run не запускается: вопрос и ответ дописываются в тред OpenAI и в БД, так что
+# следующие ходы видят полный контекст. OPENING_CACHE_SIZE=0 — выключено.
+# Кэш у каждого воркера свой; сброс через админку увеличивает поколение в
+# cache_generations, и остальные воркеры, сверяясь раз в
+# OPENING_CACHE_SYNC_INTERVAL в фоновом таске, очищают свою копию целиком —
+# get() остаётся чисто in-memory. Без БД сброс действует только на воркер,
+# принявший запрос.
+OPENING_CACHE_SIZE = int(os.getenv("OPENING_CACHE_SIZE", "500"))
+OPENING_CACHE_TTL = float(os.getenv("OPENING_CACHE_TTL", "21600"))
+OPENING_CACHE_MAX_CHARS = int(os.getenv("OPENING_CACHE_MAX_CHARS", "300"))
+OPENING_CACHE_SYNC_INTERVAL = float(os.getenv("OPENING_CACHE_SYNC_INTERVAL", "5"))
+
+def _read_cache_generation(name: str) -> int:
+    with engine.connect() as conn:
+        return conn.execute(select(CacheGeneration.generation).where(CacheGeneration.name == name)).scalar() or 0
+
+def _bump_cache_generation(name: str) -> int:
+    for _ in range(2):
+        try:
+            with engine.begin() as conn:
+                bumped = conn.execute(
+                    update(CacheGeneration)
+                    .where(CacheGeneration.name == name)
+                    .values(generation=CacheGeneration.generation + 1, updated_at=datetime.now(timezone.utc))
+                ).rowcount
+                if not bumped:
+                    conn.execute(insert(CacheGeneration).values(name=name, generation=1, updated_at=datetime.now(timezone.utc)))
+                return conn.execute(select(CacheGeneration.generation).where(CacheGeneration.name == name)).scalar_one()
+        except IntegrityError:
+            continue  # строку только что вставил параллельный сброс — повторяем UPDATE
+    raise RuntimeError(f"cannot bump cache generation {name}")
+
+def _normalize_opening(text: str) -> str:
+    text = re.sub(r"[^\w\s]", " ", (text or "").casefold())
+    return " ".join(text.split())
+
+class OpeningAnswerCache:
+    name = "opening_answers"
+
+    def __init__(self, size: int = OPENING_CACHE_SIZE, ttl: float = OPENING_CACHE_TTL):
+        self.enabled = size > 0
+        self._cache = _LRUCache(max(1, size), ttl=ttl)
+        self.stores = 0
+        self.remote_purges = 0
+        self._generation: Optional[int] = None  # последнее увиденное поколение
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self.enabled and engine is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.to_thread(self._sync)
+            await asyncio.sleep(OPENING_CACHE_SYNC_INTERVAL)
+
+    def _sync(self) -> None:
+        # дешёвая сверка: один select по PK; вызывается только из фонового таска
+        try:
+            generation = _read_cache_generation(self.name)
+        except Exception as e:
+            if DEBUG:
+                print(f"[opening-cache] generation check error: {e}")
+            return
+        if self._generation is not None and generation != self._generation:
+            self._cache.clear()
+            self.remote_purges += 1
+        self._generation = generation
+
+    def _key(self, message: str, origin: Optional[str]) -> Optional[tuple]:
+        if not self.enabled or len(message or "") > OPENING_CACHE_MAX_CHARS:
+            return None
+        normalized = _normalize_opening(message)
+        return (normalized, origin or "", ASSISTANT_ID) if normalized else None
+
+    def get(self, message: str, origin: Optional[str]) -> Optional[str]:
+        key = self._key(message, origin)
+        return self._cache.get(key) if key else None
+
+    def put(self, message: str, origin: Optional[str], reply: str) -> None:
+        key = self._key(message, origin)
+        if key and reply:
+            self._cache.set(key, reply)
+            self.stores += 1
+
+    def purge(self, message: Optional[str] = None, origin: Optional[str] = None) -> tuple[int, str]:
+        """Сбрасывает запись (или весь кэш) в этом воркере и поднимает общее поколение.
+
+        Возвращает (сколько записей удалено здесь, scope): scope="all_workers",
+        если поколение записано в БД, иначе "worker". Другие воркеры не знают,
+        какая запись сброшена, и очищают свой кэш целиком."""
+        if message is None:
+            purged = len(self._cache)
+            self._cache.clear()
+        else:
+            key = self._key(message, origin)
+            purged = int(key is not None and self._cache.pop(key, _MISSING) is not _MISSING)
+        if engine is None:
+            return purged, "worker"
+        try:
+            generation = _bump_cache_generation(self.name)
+        except Exception as e:
+            if DEBUG:
+                print(f"[opening-cache] generation bump error: {e}")
+            return purged, "worker"
+        if message is None or self._generation == generation - 1:
+            # своё поколение уже учтено — не очищать кэш повторно при сверке
+            self._generation = generation
+        return purged, "all_workers"
+
+    def stats(self) -> dict:
+        stats = self._cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            **stats,
+            "enabled": self.enabled,
+            "stores": self.stores,
+            "generation": self._generation,
+            "remote_purges": self.remote_purges,
+            "hit_ratio": round(stats["hits"] / lookups, 4) if lookups else None,
+        }
+
+opening_answers = OpeningAnswerCache()
+
+async def _serve_cached_opening(thread_id: str, origin: str, text: str, reply: str) -> None:
+    # порядок в треде важен: сначала вопрос, затем ответ
+    await _post_user_message(thread_id, origin, text)
+    with CHAT_STAGE_SECONDS.time("post_cached_reply"):
+        await client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="assistant",
+            content=reply
+        )
+    openai_history.invalidate(thread_id)
+    try:
+        await _save_message(thread_id, origin, role="assistant", content=reply)
+    except Exception:
+        pass
+
+# ── Tool dispatch ─────────────────────────────────────────────────────────
+# Tool calls одного requires_action-шага независимы: выполняем их параллельно
+# (с лимитом и таймаутом на каждый), outputs отдаём в порядке tool_calls.
+# Таймаут по умолчанию покрывает полный бюджет ретраев Bitrix плюс окно batch'а,
+# чтобы не обрывать call() посреди повторов.
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT") or BITRIX_CALL_BUDGET + BITRIX_BATCH_WINDOW + 5)
+TOOL_CONCURRENCY = int(os.getenv("TOOL_CONCURRENCY", "8"))
+LEAD_TOOL_NAMES = {"create_bitrix_lead", "crm_create_lead", "create_lead"}
+
+# Идемпотентность: повтор create_lead с тем же телефоном/email в том же thread
+# возвращает уже созданный лид без обращения к Bitrix. Ключ — нормализованные
+# контакты + thread_id; кэш в памяти с TTL, источник после рестарта — сохранённые
+# tool-сообщения в messages.
+LEAD_DEDUP_TTL = float(os.getenv("LEAD_DEDUP_TTL", str(24 * 3600)))
+_lead_dedup_cache = _LRUCache(10000, ttl=LEAD_DEDUP_TTL)
+_lead_inflight: dict[str, asyncio.Future] = {}
+
+def _lead_dedup_key(thread_id: str, args: dict) -> Optional[str]:
+    phone = args.get("phone") or args.get("phone_number")
+    email = args.get("email")
+    phone_norm = re.sub(r"\D", "", str(phone)) if phone else ""
+    email_norm = str(email).strip().lower() if email else ""
+    if not phone_norm and not email_norm:
+        return None
+    return hashlib.sha256(f"{thread_id}|{phone_norm}|{email_norm}".encode()).hexdigest()
+
+def _load_existing_lead(thread_id: str, key: str) -> Optional[int]:
+    session = _db_session()
+    if not session:
+        return None
+    try:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=LEAD_DEDUP_TTL)
+        rows = session.execute(
+            select(Message.tool_args, Message.content)
+            .join(Conversation, Message.conversation_id == Conversation.id)
+            .where(
+                Conversation.thread_id == thread_id,
+                Message.role == "tool",
+                Message.tool_name.in_(LEAD_TOOL_NAMES),
+                Message.created_at >= cutoff,
+            )
+            .order_by(Message.created_at.desc(), Message.id.desc())
+        ).all()
+        for tool_args, content in rows:
+            if not isinstance(tool_args, dict) or _lead_dedup_key(thread_id, tool_args) != key:
+                continue
+            try:
+                lead_id = json.loads(content or "{}").get("lead_id")
+            except Exception:
+                lead_id = None
+            if lead_id is not None:
+                return int(lead_id)
+        return None
+    except Exception as e:
+        if DEBUG:
+            print(f"[db] lead dedup lookup error: {e}")
+        return None
+    finally:
+        session.close()
+
+async def _create_lead_once(thread_id: str, fn_args: dict) -> tuple[int, bool]:
+    # returns (lead_id, duplicate)
+    key = _lead_dedup_key(thread_id, fn_args)
+    if key is None:
+        return await create_bitrix_lead(fn_args), False
+    cached = _lead_dedup_cache.get(key)
+    if cached is not None:
+        return cached, True
+    inflight = _lead_inflight.get(key)
+    if inflight is not None:
+        return await asyncio.shield(inflight), True
+
+    fut = asyncio.get_running_loop().create_future()
+    _lead_inflight[key] = fut
+    try:
+        lead_id = await asyncio.to_thread(_load_existing_lead, thread_id, key)
+        duplicate = lead_id is not None
+        if lead_id is None:
+            lead_id = await create_bitrix_lead(fn_args)
+        _lead_dedup_cache.set(key, lead_id)
+        fut.set_result(lead_id)
+        return lead_id, duplicate
+    except BaseException as e:
+        if not fut.done():
+            fut.set_exception(e if isinstance(e, Exception) else RuntimeError("lead creation was interrupted"))
+            fut.exception()  # помечаем как обработанное, если ждущих нет
+        raise
+    finally:
+        _lead_inflight.pop(key, None)
+
+async def _tool_create_lead(fn_name: str, fn_args: dict, thread_id: str, origin: str) -> tuple[dict, Optional[int]]:
+    lead_id_val, duplicate = await _create_lead_once(thread_id, fn_args)
+    out = {"ok": True, "lead_id": lead_id_val}
+    if duplicate:
+        out["duplicate"] = True
+    # Persist tool call
+    try:
+        await _save_message(
+            thread_id, origin, role="tool",
+            content=json.dumps(out),
+            tool_name=fn_name, tool_args=fn_args, lead_id=lead_id_val,
+        )
+    except Exception:
+        pass
+    return out, lead_id_val
+
+TOOL_HANDLERS = {name: _tool_create_lead for name in LEAD_TOOL_NAMES}
+
+async def _dispatch_tool_call(tool_call, thread_id: str, origin: str, sem: asyncio.Semaphore) -> tuple[dict, Optional[int]]:
+    fn_name = tool_call.function.name
+    try:
+        fn_args = json.loads(tool_call.function.arguments or "{}")
+    except Exception:
+        fn_args = {}
+    if DEBUG:
+        print(f"[chat] tool_call: {fn_name} args={fn_args}")
+
+    handler = TOOL_HANDLERS.get(fn_name)
+    if handler is None:
+        TOOL_CALL_SECONDS.observe(0.0, "unknown", "unknown_function")
+        return {"ok": False, "error": f"unknown function: {fn_name}"}, None
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        async with sem:
+            return await asyncio.wait_for(handler(fn_name, fn_args, thread_id, origin), TOOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        return {"ok": False, "error": f"{fn_name} timed out after {TOOL_TIMEOUT:g}s"}, None
+    except Exception as tool_error:
+        outcome = "error"
+        return {"ok": False, "error": str(tool_error)}, None
+    finally:
+        TOOL_CALL_SECONDS.observe(time.perf_counter() - started, fn_name, outcome)
+
+async def _run_tool_calls(tool_calls, thread_id: str, origin: str) -> tuple[list[dict], Optional[int]]:
+    if DEBUG:
+        print(f"[chat] requires_action: {len(tool_calls)} tool_calls")
+    sem = asyncio.Semaphore(TOOL_CONCURRENCY)
+    results = await asyncio.gather(*(
+        _dispatch_tool_call(tool_call, thread_id, origin, sem) for tool_call in tool_calls
+    ))
+    last_lead_id: int | None = None
+    tool_outputs = []
+    for tool_call, (out, lead_id_val) in zip(tool_calls, results):
+        if lead_id_val is not None:
+            last_lead_id = lead_id_val
+        tool_outputs.append({
+            "tool_call_id": tool_call.id,
+            "output": json.dumps(out)
+        })
+    return tool_outputs, last_lead_id
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 # ── POST /chat ────────────────────────────────────────────────────────────
 @app.post("/chat")
 async def chat(req: ChatRequest, request: Request):
     origin  = request.headers.get("origin", "")
     headers = cors_headers(origin)
+    started = time.perf_counter()
 
     try:
         if DEBUG:
             print(f"[chat] origin={origin} lead_id_in={req.lead_id} message={req.message[:80]!r}")
 
-        # Попытка извлечь thread_id/threadId напрямую из тела запроса для максимальной совместимости
-        body_thread_id = None
-        try:
-            body = await request.json()
-            if isinstance(body, dict):
-                body_thread_id = body.get("thread_id") or body.get("threadId")
-        except Exception:
-            body_thread_id = None
-
         # 1. thread для клиента
-        thread_id = req.thread_id or body_thread_id or (lead_threads.get(req.lead_id) if req.lead_id else None)
-        if not thread_id:
-            thread_id = client.beta.threads.create().id
-            if req.lead_id:
-                lead_threads[req.lead_id] = thread_id
-        if DEBUG:
-            print(f"[chat] thread_id={thread_id} (in={req.thread_id} body_in={body_thread_id})")
+        thread_id, new_thread = await _resolve_thread_id(req, request)
+
+        # 1a. типовой первый вопрос — ответ из кэша, без run'а
+        cached_reply = opening_answers.get(req.message, origin) if new_thread else None
+        if cached_reply is not None:
+            await _serve_cached_opening(thread_id, origin, req.message, cached_reply)
+            CHAT_REQUEST_SECONDS.observe(time.perf_counter() - started, "chat", "cached")
+            return JSONResponse({"reply": cached_reply, "thread_id": thread_id, "threadId": thread_id, "cached": True}, headers=headers)
 
         # 2. сообщение пользователя
-        client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=req.message
-        )
-        # Persist user message
-        try:
-            _save_message(thread_id, origin, role="user", content=req.message)
-        except Exception:
-            pass
+        await _post_user_message(thread_id, origin, req.message)
 
         # 3. запуск ассистента и обработка tool calls
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=ASSISTANT_ID
-        )
+        with CHAT_STAGE_SECONDS.time("run_create"):
+            run = await client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=ASSISTANT_ID
+            )
         if DEBUG:
             print(f"[chat] run_id={run.id}")
 
         last_lead_id: int | None = None
-        deadline = time.time() + 90  # fail-safe to avoid indefinite wait
+        used_tools = False
+        deadline = time.time() + RUN_TIMEOUT  # fail-safe to avoid indefinite wait
         while True:
-            if time.time() > deadline:
-                raise TimeoutError("Assistant run timeout")
-
-            run_status = client.beta.threads.runs.retrieve(
-                run_id=run.id,
-                thread_id=thread_id
-            )
+            with CHAT_STAGE_SECONDS.time("run_wait"):
+                run_status = await run_watcher.wait(thread_id, run.id, deadline=deadline)
             if DEBUG:
                 print(f"[chat] run_status={run_status.status}")
 
             if run_status.status == "requires_action":
+                used_tools = True
                 tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
-                if DEBUG:
-                    print(f"[chat] requires_action: {len(tool_calls)} tool_calls")
-                tool_outputs = []
-                for tool_call in tool_calls:
-                    fn_name = tool_call.function.name
-                    try:
-                        fn_args = json.loads(tool_call.function.arguments or "{}")
-                    except Exception:
-                        fn_args = {}
-                    if DEBUG:
-                        print(f"[chat] tool_call: {fn_name} args={fn_args}")
-
-                    out: dict
-                    try:
-                        if fn_name in {"create_bitrix_lead", "crm_create_lead", "create_lead"}:
-                            lead_id_val = create_bitrix_lead(fn_args)
-                            last_lead_id = lead_id_val
-                            out = {"ok": True, "lead_id": lead_id_val}
-                            # Persist tool call
-                            try:
-                                _save_message(
-                                    thread_id, origin, role="tool",
-                                    content=json.dumps(out),
-                                    tool_name=fn_name, tool_args=fn_args, lead_id=lead_id_val,
-                                )
-                            except Exception:
-                                pass
-                        else:
-                            out = {"ok": False, "error": f"unknown function: {fn_name}"}
-                    except Exception as tool_error:
-                        out = {"ok": False, "error": str(tool_error)}
-
-                    tool_outputs.append({
-                        "tool_call_id": tool_call.id,
-                        "output": json.dumps(out)
-                    })
-
-                client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=thread_id,
-                    run_id=run_status.id,
-                    tool_outputs=tool_outputs
-                )
+                with CHAT_STAGE_SECONDS.time("tool_calls"):
+                    tool_outputs, step_lead_id = await _run_tool_calls(tool_calls, thread_id, origin)
+                if step_lead_id is not None:
+                    last_lead_id = step_lead_id
+
+                with CHAT_STAGE_SECONDS.time("submit_tool_outputs"):
+                    await client.beta.threads.runs.submit_tool_outputs(
+                        thread_id=thread_id,
+                        run_id=run_status.id,
+                        tool_outputs=tool_outputs
+                    )
                 if DEBUG:
                     print(f"[chat] submit_tool_outputs sent: {tool_outputs}")
                 continue
@@ -340,26 +2129,30 @@ async def chat(req: ChatRequest, request: Request):
                 if DEBUG:
                     print("[chat] run completed")
                 break
-            if run_status.status in {"failed", "cancelled", "expired"}:
-                raise RuntimeError(f"Run {run.id} ended with {run_status.status}")
-            await asyncio.sleep(1)
+            raise RuntimeError(f"Run {run.id} ended with {run_status.status}")
 
         # 5. ответ ассистента
-        reply = _extract_last_text_message(client, thread_id) or ""
+        with CHAT_STAGE_SECONDS.time("fetch_reply"):
+            reply = await _extract_last_text_message(client, thread_id) or ""
         if DEBUG:
             print(f"[chat] reply_len={len(reply)} last_lead_id={last_lead_id}")
+        openai_history.invalidate(thread_id)
         # Persist assistant reply
         try:
-            _save_message(thread_id, origin, role="assistant", content=reply, lead_id=last_lead_id)
+            await _save_message(thread_id, origin, role="assistant", content=reply, lead_id=last_lead_id)
         except Exception:
             pass
+        if new_thread and not used_tools:
+            opening_answers.put(req.message, origin, reply)
 
         resp = {"reply": reply, "thread_id": thread_id, "threadId": thread_id}
         if last_lead_id is not None:
             resp["lead_id"] = last_lead_id
+        CHAT_REQUEST_SECONDS.observe(time.perf_counter() - started, "chat", "ok")
         return JSONResponse(resp, headers=headers)
 
     except Exception as e:
+        CHAT_REQUEST_SECONDS.observe(time.perf_counter() - started, "chat", "error")
         if DEBUG:
             print(f"[chat] error: {e}")
         return JSONResponse(
@@ -368,8 +2161,131 @@ async def chat(req: ChatRequest, request: Request):
             headers=headers
         )
 
-# ── OPTIONS /chat (CORS pre-flight) ───────────────────────────────────────
+# ── POST /chat/stream (SSE) ───────────────────────────────────────────────
+# События: thread → delta* → (tool)* → done | error
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request):
+    origin  = request.headers.get("origin", "")
+    headers = cors_headers(origin)
+    started = time.perf_counter()
+
+    try:
+        if DEBUG:
+            print(f"[chat/stream] origin={origin} lead_id_in={req.lead_id} message={req.message[:80]!r}")
+        thread_id, new_thread = await _resolve_thread_id(req, request)
+        cached_reply = opening_answers.get(req.message, origin) if new_thread else None
+        if cached_reply is None:
+            await _post_user_message(thread_id, origin, req.message)
+    except Exception as e:
+        CHAT_REQUEST_SECONDS.observe(time.perf_counter() - started, "chat_stream", "error")
+        if DEBUG:
+            print(f"[chat/stream] error: {e}")
+        return JSONResponse(
+            {"error": str(e), "thread_id": req.thread_id, "threadId": req.thread_id},
+            status_code=500,
+            headers=headers
+        )
+
+    async def cached_events():
+        yield _sse("thread", {"thread_id": thread_id, "threadId": thread_id})
+        try:
+            await _serve_cached_opening(thread_id, origin, req.message, cached_reply)
+            yield _sse("delta", {"text": cached_reply})
+            yield _sse("done", {"reply": cached_reply, "thread_id": thread_id, "threadId": thread_id, "cached": True})
+            CHAT_REQUEST_SECONDS.observe(time.perf_counter() - started, "chat_stream", "cached")
+        except Exception as e:
+            CHAT_REQUEST_SECONDS.observe(time.perf_counter() - started, "chat_stream", "error")
+            if DEBUG:
+                print(f"[chat/stream] error: {e}")
+            yield _sse("error", {"error": str(e), "thread_id": thread_id, "threadId": thread_id})
+
+    async def events():
+        yield _sse("thread", {"thread_id": thread_id, "threadId": thread_id})
+        last_lead_id: int | None = None
+        used_tools = False
+        reply = ""
+        deltas: list[str] = []
+        try:
+            deadline = time.time() + RUN_TIMEOUT  # fail-safe to avoid indefinite wait
+            with CHAT_STAGE_SECONDS.time("run_create"):
+                stream = await client.beta.threads.runs.create(
+                    thread_id=thread_id,
+                    assistant_id=ASSISTANT_ID,
+                    stream=True,
+                )
+            while stream is not None:
+                next_stream = None
+                async with stream:
+                    async for event in stream:
+                        if time.time() > deadline:
+                            raise TimeoutError("Assistant run timeout")
+                        kind = event.event
+                        if kind == "thread.message.delta":
+                            for part in getattr(event.data.delta, "content", None) or []:
+                                text = getattr(getattr(part, "text", None), "value", None)
+                                if getattr(part, "type", None) == "text" and text:
+                                    if not deltas:
+                                        CHAT_STAGE_SECONDS.observe(time.perf_counter() - started, "first_delta")
+                                    deltas.append(text)
+                                    yield _sse("delta", {"text": text})
+                        elif kind == "thread.message.completed":
+                            if getattr(event.data, "role", None) == "assistant":
+                                reply = _message_text(event.data) or reply
+                        elif kind == "thread.run.requires_action":
+                            used_tools = True
+                            tool_calls = event.data.required_action.submit_tool_outputs.tool_calls
+                            with CHAT_STAGE_SECONDS.time("tool_calls"):
+                                tool_outputs, step_lead_id = await _run_tool_calls(tool_calls, thread_id, origin)
+                            if step_lead_id is not None:
+                                last_lead_id = step_lead_id
+                            yield _sse("tool", {
+                                "tools": [tc.function.name for tc in tool_calls],
+                                "lead_id": last_lead_id,
+                            })
+                            next_stream = await client.beta.threads.runs.submit_tool_outputs(
+                                thread_id=thread_id,
+                                run_id=event.data.id,
+                                tool_outputs=tool_outputs,
+                                stream=True,
+                            )
+                        elif kind in {"thread.run.failed", "thread.run.cancelled", "thread.run.expired"}:
+                            raise RuntimeError(f"Run {event.data.id} ended with {event.data.status}")
+                        elif kind == "error":
+                            raise RuntimeError(getattr(event.data, "message", None) or "stream error")
+                stream = next_stream
+
+            reply = reply or "".join(deltas)
+            if DEBUG:
+                print(f"[chat/stream] reply_len={len(reply)} last_lead_id={last_lead_id}")
+            openai_history.invalidate(thread_id)
+            # Persist assistant reply
+            try:
+                await _save_message(thread_id, origin, role="assistant", content=reply, lead_id=last_lead_id)
+            except Exception:
+                pass
+            if new_thread and not used_tools:
+                opening_answers.put(req.message, origin, reply)
+
+            done = {"reply": reply, "thread_id": thread_id, "threadId": thread_id}
+            if last_lead_id is not None:
+                done["lead_id"] = last_lead_id
+            yield _sse("done", done)
+            CHAT_REQUEST_SECONDS.observe(time.perf_counter() - started, "chat_stream", "ok")
+        except Exception as e:
+            CHAT_REQUEST_SECONDS.observe(time.perf_counter() - started, "chat_stream", "error")
+            if DEBUG:
+                print(f"[chat/stream] error: {e}")
+            yield _sse("error", {"error": str(e), "thread_id": thread_id, "threadId": thread_id})
+
+    return StreamingResponse(events() if cached_reply is None else cached_events(), media_type="text/event-stream", headers={
+        **headers,
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+# ── OPTIONS /chat, /chat/stream (CORS pre-flight) ─────────────────────────
 @app.options("/chat")
+@app.options("/chat/stream")
 async def chat_options(request: Request):
     origin  = request.headers.get("origin", "")
     headers = cors_headers(origin).copy()
@@ -379,9 +2295,128 @@ async def chat_options(request: Request):
     headers["Access-Control-Max-Age"] = "86400"
     return Response(status_code=204, headers=headers)
 
+# ── История из OpenAI (fallback, когда в БД нет сообщений) ─────────────────
+# Тред читается целиком через cursor-пагинацию API (а не только первая страница),
+# сообщения конвертируются по мере поступления страниц. Результат кэшируется:
+# в пределах OPENAI_HISTORY_FRESH_TTL отдаётся без запросов к OpenAI, дальше
+# ревалидируется одним дешёвым запросом последнего message id. Курсорные
+# запросы (before=latest|<cursor>, after=<cursor>) читают только нужную страницу
+# через order/after API, начиная с конца треда.
+OPENAI_HISTORY_CACHE_SIZE = int(os.getenv("OPENAI_HISTORY_CACHE_SIZE", "1000"))
+OPENAI_HISTORY_CACHE_TTL = float(os.getenv("OPENAI_HISTORY_CACHE_TTL", "600"))
+OPENAI_HISTORY_FRESH_TTL = float(os.getenv("OPENAI_HISTORY_FRESH_TTL", "15"))
+OPENAI_HISTORY_PAGE_SIZE = 100  # максимум, который отдаёт messages.list
+
+def _openai_message_item(m, include_tools: bool) -> Optional[dict]:
+    role = getattr(m, "role", None)
+    if role not in {"user", "assistant"} and not include_tools:
+        return None
+    text_parts: list[str] = []
+    for part in getattr(m, "content", []) or []:
+        if getattr(part, "type", None) == "text" and getattr(part, "text", None):
+            value = getattr(getattr(part, "text", None), "value", None)
+            if isinstance(value, str) and value:
+                text_parts.append(value)
+    content = "\n\n".join(text_parts).strip()
+    if not content:
+        return None
+    return {
+        "id": None,
+        "role": role,
+        "content": content,
+        "tool_name": None,
+        "created_at": None,
+    }
+
+class OpenAIHistory:
+    def __init__(self):
+        # (thread_id, include_tools) → (last_message_id, fetched_at, items)
+        self._cache = _LRUCache(OPENAI_HISTORY_CACHE_SIZE, ttl=OPENAI_HISTORY_CACHE_TTL)
+        self._inflight: dict[tuple[str, bool], asyncio.Future] = {}
+
+    async def _iter_messages(self, thread_id: str):
+        # AsyncPaginator сам ходит по страницам через after-курсор
+        async for m in client.beta.threads.messages.list(thread_id, order="asc", limit=OPENAI_HISTORY_PAGE_SIZE):
+            yield m
+
+    async def _last_message_id(self, thread_id: str) -> Optional[str]:
+        page = await client.beta.threads.messages.list(thread_id, order="desc", limit=1)
+        return page.data[0].id if page.data else None
+
+    async def _fetch(self, thread_id: str, include_tools: bool) -> tuple[Optional[str], list[dict], list[str]]:
+        last_id = None
+        items: list[dict] = []
+        ids: list[str] = []  # OpenAI id сообщения каждого item — для курсоров
+        async for m in self._iter_messages(thread_id):
+            last_id = m.id
+            item = _openai_message_item(m, include_tools)
+            if item is not None:
+                item["id"] = len(items) + 1  # synthetic numeric id for UI stability
+                items.append(item)
+                ids.append(m.id)
+        return last_id, items, ids
+
+    async def _load(self, key: tuple[str, bool]) -> tuple[list[dict], list[str]]:
+        thread_id, include_tools = key
+        cached = self._cache.get(key)
+        if cached is not None:
+            last_id, fetched_at, items, ids = cached
+            if time.monotonic() - fetched_at < OPENAI_HISTORY_FRESH_TTL:
+                return items, ids
+            if await self._last_message_id(thread_id) == last_id:
+                self._cache.set(key, (last_id, time.monotonic(), items, ids))
+                return items, ids
+        last_id, items, ids = await self._fetch(thread_id, include_tools)
+        self._cache.set(key, (last_id, time.monotonic(), items, ids))
+        return items, ids
+
+    async def page(self, thread_id: str, include_tools: bool, *, before: Optional[str], after: Optional[str], limit: int) -> tuple[list[dict], bool, Optional[str], Optional[str]]:
+        # before=None и after=None — последняя страница (before=latest).
+        # В API order=desc + after=<id> — сообщения старше id, order=asc + after=<id> — новее.
+        backwards = after is None
+        kwargs = {"order": "desc" if backwards else "asc", "limit": min(limit + 1, OPENAI_HISTORY_PAGE_SIZE)}
+        if backwards and before:
+            kwargs["after"] = before
+        elif not backwards:
+            kwargs["after"] = after
+        raw = []
+        async for m in client.beta.threads.messages.list(thread_id, **kwargs):
+            raw.append(m)
+            if len(raw) > limit:
+                break
+        has_more = len(raw) > limit
+        raw = raw[:limit]
+        if backwards:
+            raw.reverse()
+        items = []
+        for m in raw:
+            item = _openai_message_item(m, include_tools)
+            if item is not None:
+                item["id"] = m.id  # позиция в треде неизвестна — отдаём id сообщения OpenAI
+                items.append(item)
+        first_id = raw[0].id if raw else None
+        last_id = raw[-1].id if raw else None
+        return items, has_more, first_id, last_id
+
+    async def get(self, thread_id: str, include_tools: bool = False) -> tuple[list[dict], list[str]]:
+        key = (thread_id, include_tools)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        task = asyncio.ensure_future(self._load(key))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _t: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def invalidate(self, thread_id: str) -> None:
+        for include_tools in (False, True):
+            self._cache.pop((thread_id, include_tools))
+
+openai_history = OpenAIHistory()
+
 # ── Публичная история переписки по thread_id ───────────────────────────────
 @app.get("/chat/history")
-async def chat_history(request: Request, thread_id: Optional[str] = None, threadId: Optional[str] = None, limit: int = 500, offset: int = 0, include_tools: Optional[bool] = None):
+async def chat_history(request: Request, thread_id: Optional[str] = None, threadId: Optional[str] = None, limit: int = 500, offset: int = 0, include_tools: Optional[bool] = None, before: Optional[str] = None, after: Optional[str] = None):
     origin  = request.headers.get("origin", "")
     headers = cors_headers(origin)
 
@@ -392,42 +2427,41 @@ async def chat_history(request: Request, thread_id: Optional[str] = None, thread
     except Exception:
         limit_val, offset_val = 500, 0
 
+    # keyset cursors: before=<cursor>|latest — более старые сообщения, after=<cursor> — более новые.
+    # Курсоры страниц, прочитанных из OpenAI, продолжают листать тред в OpenAI.
+    before_key = after_key = None
+    before_oa = _decode_openai_cursor(before)
+    after_oa = _decode_openai_cursor(after)
+    if before and before != "latest" and before_oa is None:
+        before_key = _decode_message_cursor(before)
+        if before_key is None:
+            return JSONResponse({"error": "invalid before cursor"}, status_code=400, headers=headers)
+    if after and after_oa is None:
+        after_key = _decode_message_cursor(after)
+        if after_key is None:
+            return JSONResponse({"error": "invalid after cursor"}, status_code=400, headers=headers)
+
     # normalize thread id
     tid = thread_id or threadId
     if not tid:
         return JSONResponse({"error": "thread_id is required"}, status_code=400, headers=headers)
 
     # helper: fetch history from OpenAI directly
-    def _openai_history_response() -> JSONResponse:
+    async def _openai_history_response() -> JSONResponse:
         try:
-            messages = client.beta.threads.messages.list(tid, order="asc")
+            if before or after:
+                items_page, has_more, first_id, last_id = await openai_history.page(
+                    tid, include_tools is True, before=before_oa, after=after_oa, limit=limit_val,
+                )
+            else:
+                items_all, ids_all = await openai_history.get(tid, include_tools is True)
+                items_page = items_all[offset_val: offset_val + limit_val]
+                ids_page = ids_all[offset_val: offset_val + limit_val]
+                has_more = offset_val + limit_val < len(items_all)
+                first_id = ids_page[0] if ids_page else None
+                last_id = ids_page[-1] if ids_page else None
         except Exception as e:
             return JSONResponse({"error": f"OpenAI fetch failed: {e}"}, status_code=502, headers=headers)
-        items_all = []
-        seq = 1
-        for m in messages.data:
-            role = getattr(m, "role", None)
-            if role not in {"user", "assistant"} and include_tools is not True:
-                continue
-            text_parts: list[str] = []
-            for part in getattr(m, "content", []) or []:
-                if getattr(part, "type", None) == "text" and getattr(part, "text", None):
-                    value = getattr(getattr(part, "text", None), "value", None)
-                    if isinstance(value, str) and value:
-                        text_parts.append(value)
-            content = "\n\n".join(text_parts).strip()
-            if not content:
-                continue
-            items_all.append({
-                "id": seq,  # synthetic numeric id for UI stability
-                "role": role,
-                "content": content,
-                "tool_name": None,
-                "created_at": None,
-            })
-            seq += 1
-        # pagination
-        items_page = items_all[offset_val: offset_val + limit_val]
         return JSONResponse({
             "conversation": {
                 "id": None,
@@ -439,28 +2473,45 @@ async def chat_history(request: Request, thread_id: Optional[str] = None, thread
             "items": items_page,
             "limit": limit_val,
             "offset": offset_val,
+            "has_more": has_more,
+            "cursors": {"before": _openai_cursor(first_id), "after": _openai_cursor(last_id)},
         }, headers=headers)
 
-    # If DB is not configured, fall back to OpenAI
-    if not SessionLocal:
-        return _openai_history_response()
+    # If DB is not configured (or the cursor came from an OpenAI page), read from OpenAI
+    if not SessionLocal or before_oa or after_oa:
+        return await _openai_history_response()
 
     # Normal path: read from DB, otherwise fallback
     session = SessionLocal()
     try:
         conv = session.query(Conversation).filter_by(thread_id=tid).one_or_none()
         if not conv:
-            return _openai_history_response()
+            return await _openai_history_response()
 
         q = session.query(Message).filter_by(conversation_id=conv.id)
         if include_tools is not True:
             q = q.filter(Message.role.in_(["user", "assistant"]))
-        q = q.order_by(Message.created_at.asc(), Message.id.asc())
-        rows = q.all()
-        if not rows:
-            return _openai_history_response()
-        # pagination in-memory for consistent behavior
-        rows = rows[offset_val: offset_val + limit_val]
+        backwards = bool(before)
+        if after_key:
+            c_dt, c_id = after_key
+            q = q.filter(or_(Message.created_at > c_dt, and_(Message.created_at == c_dt, Message.id > c_id)))
+        if before_key:
+            c_dt, c_id = before_key
+            q = q.filter(or_(Message.created_at < c_dt, and_(Message.created_at == c_dt, Message.id < c_id)))
+        if backwards:
+            q = q.order_by(Message.created_at.desc(), Message.id.desc())
+        else:
+            q = q.order_by(Message.created_at.asc(), Message.id.asc())
+        if not (before or after):
+            q = q.offset(offset_val)
+        # pagination in SQL; +1 row tells whether there is another page
+        rows = q.limit(limit_val + 1).all()
+        has_more = len(rows) > limit_val
+        rows = rows[:limit_val]
+        if backwards:
+            rows.reverse()
+        if not rows and not (before_key or after_key) and offset_val == 0:
+            return await _openai_history_response()
 
         items = []
         for m in rows:
@@ -482,6 +2533,11 @@ async def chat_history(request: Request, thread_id: Optional[str] = None, thread
             "items": items,
             "limit": limit_val,
             "offset": offset_val,
+            "has_more": has_more,
+            "cursors": {
+                "before": _message_cursor(rows[0]) if rows else None,
+                "after": _message_cursor(rows[-1]) if rows else None,
+            },
         }, headers=headers)
     finally:
         session.close()
@@ -495,8 +2551,271 @@ def _require_admin(request: Request):
     if token != ADMIN_TOKEN:
         raise PermissionError("unauthorized")
 
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        return int(value)
+    except Exception:
+        return None
+
+def _message_filters(qp) -> dict:
+    return {
+        "roles": sorted({r.strip() for r in (qp.get("role") or "").split(',') if r.strip()}) or None,
+        "from": _parse_dt(qp.get("from")),
+        "to": _parse_dt(qp.get("to")),
+        "lead_id": _parse_int(qp.get("lead_id")),
+        "has_lead": _parse_bool(qp.get("has_lead")),
+        "thread_id": qp.get("thread_id") or None,
+        "origin": qp.get("origin") or None,  # exact or suffix with leading *
+        "tool_name": qp.get("tool_name") or None,
+        "search": qp.get("search") or None,
+    }
+
+def _filter_origin(q, origin: Optional[str]):
+    if origin:
+        if origin.startswith("*"):
+            q = q.filter(Conversation.origin.ilike(f"%{origin[1:]}") )
+        else:
+            q = q.filter(Conversation.origin == origin)
+    return q
+
+def _filter_has_lead(q, has_lead: Optional[bool]):
+    if has_lead is True:
+        q = q.filter(Conversation.lead_id.isnot(None))
+    elif has_lead is False:
+        q = q.filter(Conversation.lead_id.is_(None))
+    return q
+
+def _filter_messages(q, f: dict, *, search: bool = True):
+    # q — запрос с Message, уже соединённым с Conversation
+    if f["roles"]:
+        q = q.filter(Message.role.in_(f["roles"]))
+    if f["from"]:
+        q = q.filter(Message.created_at >= f["from"])
+    if f["to"]:
+        q = q.filter(Message.created_at <= f["to"])
+    if f["lead_id"] is not None:
+        q = q.filter(Conversation.lead_id == f["lead_id"])
+    q = _filter_has_lead(q, f["has_lead"])
+    if f["thread_id"]:
+        q = q.filter(Conversation.thread_id == f["thread_id"])
+    q = _filter_origin(q, f["origin"])
+    if f["tool_name"]:
+        if f["tool_name"] == "*":
+            q = q.filter(Message.tool_name.isnot(None))
+        else:
+            q = q.filter(Message.tool_name == f["tool_name"])
+    if search and f["search"]:
+        q, _, _ = _apply_message_search(q, f["search"])
+    return q
+
+def _conversation_filters(qp) -> dict:
+    return {
+        "from": _parse_dt(qp.get("from")),
+        "to": _parse_dt(qp.get("to")),
+        "origin": qp.get("origin") or None,  # exact or suffix with leading *
+        "has_lead": _parse_bool(qp.get("has_lead")),
+        "thread_id": qp.get("thread_id") or None,
+        "min_messages": _parse_int(qp.get("min_messages")),
+        "max_messages": _parse_int(qp.get("max_messages")),
+        "has_tool_calls": _parse_bool(qp.get("has_tool_calls")),
+        "active_since": _parse_dt(qp.get("active_since")),   # last_message_at >=
+        "stale_before": _parse_dt(qp.get("stale_before")),   # last_message_at <
+    }
+
+CONVERSATION_STAT_FIELDS = ("messages_count", "tool_calls_count", "last_message_at", "first_user_message_at", "last_user_message_at")
+CONVERSATION_STAT_FILTERS = ("min_messages", "max_messages", "has_tool_calls", "active_since", "stale_before")
+
+def _conversation_stats_select():
+    # та же статистика, что пишет _backfill_conversation_stats, — агрегатом по messages
+    return select(
+        Message.conversation_id.label("conversation_id"),
+        func.count(Message.id).label("messages_count"),
+        func.count(case((Message.role == "tool", Message.id))).label("tool_calls_count"),
+        func.max(Message.created_at).label("last_message_at"),
+        func.min(case((Message.role == "user", Message.created_at))).label("first_user_message_at"),
+        func.max(case((Message.role == "user", Message.created_at))).label("last_user_message_at"),
+    ).group_by(Message.conversation_id)
+
+def _conversation_stat_columns(q, f: dict, sort_by: str):
+    """(q, {поле: выражение}) для фильтров и сортировки по статистике бесед.
+
+    Пока online-миграция 5 не применена, денормализованные колонки старых бесед
+    пусты — фильтр или сортировка по ним идут через агрегат по messages."""
+    cols = {name: getattr(Conversation, name) for name in CONVERSATION_STAT_FIELDS}
+    if _migration_applied(5):
+        return q, cols
+    if sort_by not in cols and all(f[k] is None for k in CONVERSATION_STAT_FILTERS):
+        return q, cols
+    agg = _conversation_stats_select().subquery()
+    q = q.outerjoin(agg, agg.c.conversation_id == Conversation.id)
+    return q, {
+        "messages_count": func.coalesce(agg.c.messages_count, 0),
+        "tool_calls_count": func.coalesce(agg.c.tool_calls_count, 0),
+        "last_message_at": func.coalesce(agg.c.last_message_at, Conversation.created_at),
+        "first_user_message_at": agg.c.first_user_message_at,
+        "last_user_message_at": agg.c.last_user_message_at,
+    }
+
+def _page_conversation_stats(session, conversations) -> Optional[dict]:
+    # до миграции 5 статистика страницы считается GROUP BY по её бесед
+    if _migration_applied(5) or not conversations:
+        return None
+    created = {c.id: c.created_at for c in conversations}
+    stats = {cid: {"messages_count": 0, "tool_calls_count": 0, "last_message_at": created_at,
+                   "first_user_message_at": None, "last_user_message_at": None}
+             for cid, created_at in created.items()}
+    rows = session.execute(_conversation_stats_select().where(Message.conversation_id.in_(list(created)))).all()
+    for row in rows:
+        stats[row.conversation_id] = {name: getattr(row, name) for name in CONVERSATION_STAT_FIELDS}
+    return stats
+
+def _filter_conversations(q, f: dict, cols: Optional[dict] = None):
+    cols = cols or {name: getattr(Conversation, name) for name in CONVERSATION_STAT_FIELDS}
+    if f["from"]:
+        q = q.filter(Conversation.created_at >= f["from"])
+    if f["to"]:
+        q = q.filter(Conversation.created_at <= f["to"])
+    if f["thread_id"]:
+        q = q.filter(Conversation.thread_id == f["thread_id"])
+    q = _filter_origin(q, f["origin"])
+    if f["min_messages"] is not None:
+        q = q.filter(cols["messages_count"] >= f["min_messages"])
+    if f["max_messages"] is not None:
+        q = q.filter(cols["messages_count"] <= f["max_messages"])
+    if f["has_tool_calls"] is True:
+        q = q.filter(cols["tool_calls_count"] > 0)
+    elif f["has_tool_calls"] is False:
+        q = q.filter(cols["tool_calls_count"] == 0)
+    if f["active_since"]:
+        q = q.filter(cols["last_message_at"] >= f["active_since"])
+    if f["stale_before"]:
+        q = q.filter(cols["last_message_at"] < f["stale_before"])
+    return _filter_has_lead(q, f["has_lead"])
+
+# ── Admin totals: exact | cached | estimated ───────────────────────────────
+# COUNT(*) по всему отфильтрованному запросу на больших таблицах дороже самой
+# страницы. cached — TTL-кэш по нормализованному набору фильтров, estimated —
+# оценка планировщика Postgres (EXPLAIN), none — без total. В ответе
+# total_strategy говорит, чем total получен на самом деле.
+ADMIN_COUNT_STRATEGIES = {"exact", "cached", "estimated", "none"}
+ADMIN_COUNT_DEFAULT = os.getenv("ADMIN_COUNT_STRATEGY", "cached")
+ADMIN_COUNT_CACHE_TTL = float(os.getenv("ADMIN_COUNT_CACHE_TTL", "30"))
+_count_cache = _LRUCache(1000, ttl=ADMIN_COUNT_CACHE_TTL)
+
+def _filters_key(name: str, f: dict) -> tuple:
+    def norm(v):
+        if isinstance(v, datetime):
+            return v.isoformat()
+        if isinstance(v, list):
+            return tuple(v)
+        return v
+    return (name,) + tuple((k, norm(v)) for k, v in sorted(f.items()))
+
+def _estimate_count(session, q) -> Optional[int]:
+    bind = session.get_bind()
+    if bind.dialect.name != "postgresql":
+        return None
+    try:
+        compiled = q.order_by(None).statement.compile(dialect=bind.dialect, compile_kwargs={"render_postcompile": True})
+        plan = session.connection().exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except Exception as e:
+        if DEBUG:
+            print(f"[db] count estimate error: {e}")
+        return None
+
+def _count_total(session, q, strategy: Optional[str], cache_key: tuple) -> tuple[Optional[int], str]:
+    strategy = strategy if strategy in ADMIN_COUNT_STRATEGIES else ADMIN_COUNT_DEFAULT
+    if strategy == "none":
+        return None, "none"
+    if strategy == "estimated":
+        estimate = _estimate_count(session, q)
+        if estimate is not None:
+            return estimate, "estimated"
+        strategy = "cached"  # не Postgres — честный, но закэшированный count
+    if strategy == "cached":
+        cached = _count_cache.get(cache_key)
+        if cached is not None:
+            return cached, "cached"
+    total = q.order_by(None).count()
+    _count_cache.set(cache_key, total)
+    return total, "exact"
+
+# ── Admin keyset (seek) pagination ─────────────────────────────────────────
+# paginate=keyset или cursor=<next_cursor>: страница продолжается от последней
+# строки по (ключ сортировки, id) — стоимость не растёт с глубиной, строки не
+# «съезжают» при новых записях. Курсор хранит sort_by/sort_dir, ключ и id.
+# NULL в ключе (last_message_at до backfill) считается больше любого значения —
+# как по умолчанию в Postgres (ASC NULLS LAST / DESC NULLS FIRST), что совпадает
+# с обходом btree-индекса; на SQLite порядок задаётся явно, ключ NULL в курсоре —
+# JSON null.
+def _order_with_tiebreak(q, sort_col, id_col, desc: bool):
+    if sort_col is id_col:
+        return q.order_by(id_col.desc() if desc else id_col.asc())
+    if desc:
+        return q.order_by(sort_col.desc().nulls_first(), id_col.desc())
+    return q.order_by(sort_col.asc().nulls_last(), id_col.asc())
+
+def _keyset_seek(q, sort_col, id_col, desc: bool, cursor: str, sort_by: str):
+    values = _decode_cursor(cursor)
+    if not values or len(values) != 4 or values[0] != sort_by or values[1] != ("desc" if desc else "asc"):
+        raise ValueError("invalid cursor (or it was issued for another sort_by/sort_dir)")
+    key, last_id = values[2], values[3]
+    if not isinstance(last_id, int) or (key is None and sort_col is id_col):
+        raise ValueError("invalid cursor")
+    try:
+        if key is not None and isinstance(sort_col.type, DateTime):
+            key = datetime.fromisoformat(key)
+    except (TypeError, ValueError):
+        raise ValueError("invalid cursor")
+
+    def beyond(col, value):
+        return col < value if desc else col > value
+
+    if sort_col is id_col:
+        return q.filter(beyond(id_col, last_id))
+    if key is None:
+        # NULL-группа: по убыванию за ней идут все не-NULL, по возрастанию — ничего
+        in_nulls = and_(sort_col.is_(None), beyond(id_col, last_id))
+        return q.filter(or_(in_nulls, sort_col.isnot(None)) if desc else in_nulls)
+    after_key = or_(beyond(sort_col, key), and_(sort_col == key, beyond(id_col, last_id)))
+    return q.filter(after_key if desc else or_(after_key, sort_col.is_(None)))
+
+def _keyset_cursor(sort_by: str, desc: bool, key, row_id: int) -> str:
+    return _encode_cursor([sort_by, "desc" if desc else "asc", key, row_id])
+
 # ── Admin endpoints (read-only) ────────────────────────────────────────────
 
+CONVERSATION_SORT_COLUMNS = {
+    "created_at": Conversation.created_at,
+    "id": Conversation.id,
+    "messages_count": Conversation.messages_count,
+    "tool_calls_count": Conversation.tool_calls_count,
+    "last_message_at": Conversation.last_message_at,
+}
+
+def _iso(dt: Optional[datetime]) -> Optional[str]:
+    return dt.isoformat() if dt else None
+
+def _conversation_item(c, stats: Optional[dict] = None) -> dict:
+    st = stats or {name: getattr(c, name) for name in CONVERSATION_STAT_FIELDS}
+    return {
+        "id": c.id,
+        "thread_id": c.thread_id,
+        "lead_id": c.lead_id,
+        "origin": c.origin,
+        "created_at": _iso(c.created_at),
+        "messages_count": st["messages_count"] or 0,
+        "tool_calls_count": st["tool_calls_count"] or 0,
+        "last_message_at": _iso(st["last_message_at"]),
+        "first_user_message_at": _iso(st["first_user_message_at"]),
+        "last_user_message_at": _iso(st["last_user_message_at"]),
+    }
+
 @app.get("/admin/conversations")
 async def admin_list_conversations(request: Request):
     try:
@@ -509,13 +2828,11 @@ async def admin_list_conversations(request: Request):
 
     limit_param = request.query_params.get("limit", "50")
     offset_param = request.query_params.get("offset", "0")
-    from_param = request.query_params.get("from")
-    to_param = request.query_params.get("to")
-    origin_param = request.query_params.get("origin")  # exact or suffix with leading *
-    has_lead_param = request.query_params.get("has_lead")
-    thread_param = request.query_params.get("thread_id")
-    sort_by = request.query_params.get("sort_by", "created_at")  # created_at|id
+    sort_by = request.query_params.get("sort_by", "created_at")  # см. CONVERSATION_SORT_COLUMNS
     sort_dir = request.query_params.get("sort_dir", "desc")       # asc|desc
+    count_param = request.query_params.get("count")              # exact|cached|estimated|none
+    cursor_param = request.query_params.get("cursor")
+    keyset = bool(cursor_param) or request.query_params.get("paginate") == "keyset"
 
     try:
         limit = max(1, min(200, int(limit_param)))
@@ -523,64 +2840,41 @@ async def admin_list_conversations(request: Request):
     except Exception:
         limit, offset = 50, 0
 
-    dt_from = _parse_dt(from_param)
-    dt_to = _parse_dt(to_param)
-    has_lead = _parse_bool(has_lead_param)
+    filters = _conversation_filters(request.query_params)
 
     session = SessionLocal()
     try:
-        q = session.query(Conversation)
-        if dt_from:
-            q = q.filter(Conversation.created_at >= dt_from)
-        if dt_to:
-            q = q.filter(Conversation.created_at <= dt_to)
-        if thread_param:
-            q = q.filter(Conversation.thread_id == thread_param)
-        if origin_param:
-            if origin_param.startswith("*"):
-                q = q.filter(Conversation.origin.ilike(f"%{origin_param[1:]}") )
-            else:
-                q = q.filter(Conversation.origin == origin_param)
-        if has_lead is True:
-            q = q.filter(Conversation.lead_id.isnot(None))
-        elif has_lead is False:
-            q = q.filter(Conversation.lead_id.is_(None))
+        sort_by = sort_by if sort_by in CONVERSATION_SORT_COLUMNS else "id"
+        q, stat_cols = _conversation_stat_columns(session.query(Conversation), filters, sort_by)
+        q = _filter_conversations(q, filters, stat_cols)
+        total, total_strategy = _count_total(session, q, count_param, _filters_key("conversations", filters))
 
         # sort
-        order_col = Conversation.created_at if sort_by == "created_at" else Conversation.id
-        if sort_dir == "asc":
-            q = q.order_by(order_col.asc())
-        else:
-            q = q.order_by(order_col.desc())
-
-        total = q.count()
-        conversations = q.offset(offset).limit(limit).all()
-        # augment with messages_count and last_message_at
-        conv_ids = [c.id for c in conversations]
-        stats = {}
-        if conv_ids:
-            mstats = (
-                session.query(Message.conversation_id, func.count(Message.id), func.max(Message.created_at))
-                .filter(Message.conversation_id.in_(conv_ids))
-                .group_by(Message.conversation_id)
-                .all()
-            )
-            for cid, cnt, last_dt in mstats:
-                stats[cid] = {"messages_count": int(cnt), "last_message_at": last_dt.isoformat() if last_dt else None}
+        order_col = stat_cols.get(sort_by, CONVERSATION_SORT_COLUMNS[sort_by])
+        desc = sort_dir != "asc"
+        q = _order_with_tiebreak(q, order_col, Conversation.id, desc)
 
-        items = []
-        for c in conversations:
-            s = stats.get(c.id, {"messages_count": 0, "last_message_at": None})
-            items.append({
-                "id": c.id,
-                "thread_id": c.thread_id,
-                "lead_id": c.lead_id,
-                "origin": c.origin,
-                "created_at": c.created_at.isoformat() if c.created_at else None,
-                "messages_count": s["messages_count"],
-                "last_message_at": s["last_message_at"],
-            })
-        return JSONResponse({"total": total, "limit": limit, "offset": offset, "items": items})
+        next_cursor = None
+        if keyset:
+            if cursor_param:
+                try:
+                    q = _keyset_seek(q, order_col, Conversation.id, desc, cursor_param, sort_by)
+                except ValueError as e:
+                    return JSONResponse({"error": str(e)}, status_code=400)
+            conversations = q.limit(limit + 1).all()
+            has_more = len(conversations) > limit
+            conversations = conversations[:limit]
+            offset = None
+        else:
+            conversations = q.offset(offset).limit(limit).all()
+            has_more = False
+        page_stats = _page_conversation_stats(session, conversations)
+        if has_more:
+            last = conversations[-1]
+            key = page_stats[last.id][sort_by] if page_stats and sort_by in CONVERSATION_STAT_FIELDS else getattr(last, sort_by)
+            next_cursor = _keyset_cursor(sort_by, desc, key, last.id)
+        items = [_conversation_item(c, page_stats and page_stats[c.id]) for c in conversations]
+        return JSONResponse({"total": total, "total_strategy": total_strategy, "limit": limit, "offset": offset, "next_cursor": next_cursor, "items": items})
     finally:
         session.close()
 
@@ -685,17 +2979,13 @@ async def admin_list_messages(request: Request):
     qp = request.query_params
     limit_param = qp.get("limit", "100")
     offset_param = qp.get("offset", "0")
-    roles_param = qp.get("role")  # e.g. user,assistant,tool
-    from_param = qp.get("from")
-    to_param = qp.get("to")
-    lead_param = qp.get("lead_id")
-    has_lead_param = qp.get("has_lead")
-    thread_param = qp.get("thread_id")
-    origin_param = qp.get("origin")
-    tool_param = qp.get("tool_name")
-    search_param = qp.get("search")
-    sort_by = qp.get("sort_by", "created_at")   # created_at|id
+    count_param = qp.get("count")  # exact|cached|estimated|none
+    filters = _message_filters(qp)
+    search_param = filters["search"]
+    sort_by = qp.get("sort_by", "rank" if search_param else "created_at")   # created_at|id|rank (rank — при search)
     sort_dir = qp.get("sort_dir", "desc")       # asc|desc
+    cursor_param = qp.get("cursor")
+    keyset = bool(cursor_param) or qp.get("paginate") == "keyset"
 
     try:
         limit = max(1, min(500, int(limit_param)))
@@ -703,59 +2993,50 @@ async def admin_list_messages(request: Request):
     except Exception:
         limit, offset = 100, 0
 
-    dt_from = _parse_dt(from_param)
-    dt_to = _parse_dt(to_param)
-    has_lead = _parse_bool(has_lead_param)
-
-    roles = None
-    if roles_param:
-        roles = [r.strip() for r in roles_param.split(',') if r.strip()]
+    if keyset and sort_by == "rank":
+        if "sort_by" in qp:
+            return JSONResponse({"error": "keyset pagination supports sort_by=created_at|id"}, status_code=400)
+        sort_by = "created_at"
 
     session = SessionLocal()
     try:
         q = session.query(Message, Conversation).join(Conversation, Message.conversation_id == Conversation.id)
-        if roles:
-            q = q.filter(Message.role.in_(roles))
-        if dt_from:
-            q = q.filter(Message.created_at >= dt_from)
-        if dt_to:
-            q = q.filter(Message.created_at <= dt_to)
-        if lead_param:
-            try:
-                lead_val = int(lead_param)
-                q = q.filter(Conversation.lead_id == lead_val)
-            except Exception:
-                pass
-        if has_lead is True:
-            q = q.filter(Conversation.lead_id.isnot(None))
-        elif has_lead is False:
-            q = q.filter(Conversation.lead_id.is_(None))
-        if thread_param:
-            q = q.filter(Conversation.thread_id == thread_param)
-        if origin_param:
-            if origin_param.startswith("*"):
-                q = q.filter(Conversation.origin.ilike(f"%{origin_param[1:]}") )
-            else:
-                q = q.filter(Conversation.origin == origin_param)
-        if tool_param:
-            if tool_param == "*":
-                q = q.filter(Message.tool_name.isnot(None))
-            else:
-                q = q.filter(Message.tool_name == tool_param)
+        q = _filter_messages(q, filters, search=False)
+        rank_col = snippet_col = None
         if search_param:
-            q = q.filter(Message.content.ilike(f"%{search_param}%"))
+            q, rank_col, snippet_col = _apply_message_search(q, search_param, ranked=True)
 
-        order_col = Message.created_at if sort_by == "created_at" else Message.id
-        if sort_dir == "asc":
-            q = q.order_by(order_col.asc())
+        total, total_strategy = _count_total(session, q, count_param, _filters_key("messages", filters))
+        if rank_col is not None:
+            q = q.add_columns(rank_col, snippet_col)
+
+        desc = sort_dir != "asc"
+        if sort_by == "rank" and rank_col is not None:
+            q = q.order_by(rank_col.desc() if desc else rank_col.asc(), Message.id.desc())
         else:
-            q = q.order_by(order_col.desc())
+            sort_by = "created_at" if sort_by == "created_at" else "id"
+            order_col = Message.created_at if sort_by == "created_at" else Message.id
+            q = _order_with_tiebreak(q, order_col, Message.id, desc)
 
-        total = q.count()
-        rows = q.offset(offset).limit(limit).all()
+        next_cursor = None
+        if keyset:
+            if cursor_param:
+                try:
+                    q = _keyset_seek(q, order_col, Message.id, desc, cursor_param, sort_by)
+                except ValueError as e:
+                    return JSONResponse({"error": str(e)}, status_code=400)
+            rows = q.limit(limit + 1).all()
+            if len(rows) > limit:
+                rows = rows[:limit]
+                last = rows[-1][0]
+                next_cursor = _keyset_cursor(sort_by, desc, getattr(last, sort_by), last.id)
+            offset = None
+        else:
+            rows = q.offset(offset).limit(limit).all()
         items = []
-        for m, c in rows:
-            items.append({
+        for row in rows:
+            m, c = row[0], row[1]
+            item = {
                 "id": m.id,
                 "role": m.role,
                 "content": m.content,
@@ -769,92 +3050,621 @@ async def admin_list_messages(request: Request):
                     "origin": c.origin,
                     "created_at": c.created_at.isoformat() if c.created_at else None,
                 }
-            })
-        return JSONResponse({"total": total, "limit": limit, "offset": offset, "items": items})
+            }
+            if rank_col is not None:
+                item["rank"] = float(row[2]) if row[2] is not None else None
+                item["snippet"] = row[3]
+            items.append(item)
+        return JSONResponse({"total": total, "total_strategy": total_strategy, "limit": limit, "offset": offset, "next_cursor": next_cursor, "items": items})
     finally:
         session.close()
 
-@app.get("/admin/export/messages.ndjson")
-async def admin_export_messages_ndjson(request: Request):
-    try:
-        _require_admin(request)
-    except PermissionError as e:
-        return JSONResponse({"error": str(e)}, status_code=401)
+# ── Admin: bulk export ─────────────────────────────────────────────────────
+# Строки собираются в буферы ~EXPORT_CHUNK_SIZE байт (одна отправка ASGI на
+# буфер, а не на строку), JSON — через orjson, если установлен. Сжатие по
+# Accept-Encoding: zstd (пакет zstandard, опционально) или gzip.
+# Докачка: after=<cursor> / after_id=<id> (строго после) или заголовок
+# Range: messages=<id>- (начиная с id, ответ 206). Порядок — (created_at, id).
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", str(64 * 1024)))
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "1000"))
+EXPORT_GZIP_LEVEL = int(os.getenv("EXPORT_GZIP_LEVEL", "4"))
+EXPORT_ZSTD_LEVEL = int(os.getenv("EXPORT_ZSTD_LEVEL", "3"))
+EXPORT_CSV_HEADER = [
+    "msg_id", "role", "content", "tool_name", "tool_args", "msg_created_at",
+    "conv_id", "thread_id", "lead_id", "origin", "conv_created_at",
+]
 
-    if not SessionLocal:
-        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
+try:
+    import orjson
+except ImportError:  # опционально: json из stdlib медленнее, но формат тот же
+    orjson = None
 
-    qp = request.query_params
-    dt_from = _parse_dt(qp.get("from"))
-    dt_to = _parse_dt(qp.get("to"))
-    roles = [r.strip() for r in qp.get("role", "").split(',') if r.strip()] or None
-    origin_param = qp.get("origin")
-    thread_param = qp.get("thread_id")
-    has_lead = _parse_bool(qp.get("has_lead"))
-    lead_param = qp.get("lead_id")
-    tool_param = qp.get("tool_name")
-    search_param = qp.get("search")
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def _json_bytes(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+def _export_encoding(request: Request) -> Optional[str]:
+    accepted = {}
+    for part in (request.headers.get("accept-encoding") or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    if zstandard is not None and accepted.get("zstd", 0) > 0:
+        return "zstd"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+def _compressed(chunks, encoding: Optional[str]):
+    if encoding is None:
+        yield from chunks
+        return
+    if encoding == "zstd":
+        comp = zstandard.ZstdCompressor(level=EXPORT_ZSTD_LEVEL).compressobj()
+    else:
+        comp = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 = gzip-обёртка
+    for chunk in chunks:
+        out = comp.compress(chunk)
+        if out:
+            yield out
+    yield comp.flush()
+
+def _buffered(pieces, size: int = EXPORT_CHUNK_SIZE):
+    buf, n = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        n += len(piece)
+        if n >= size:
+            yield b"".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield b"".join(buf)
+
+def _export_start(request: Request, session):
+    """Точка докачки: (created_at, id, inclusive) или None. ValueError — 400/416."""
+    after = request.query_params.get("after")
+    if after:
+        key = _decode_message_cursor(after)
+        if key is None:
+            raise ValueError("invalid after cursor")
+        return key[0], key[1], False
+    after_id = request.query_params.get("after_id")
+    range_header = request.headers.get("range")
+    if after_id is None and range_header:
+        unit, _, spec = range_header.partition("=")
+        start, sep, end = spec.strip().partition("-")
+        if unit.strip().lower() != "messages" or not sep or end.strip() or not start.strip().isdigit():
+            raise LookupError("only 'Range: messages=<id>-' is supported")
+        msg_id, inclusive = int(start), True
+    elif after_id is not None:
+        msg_id, inclusive = _parse_int(after_id), False
+        if msg_id is None:
+            raise ValueError("invalid after_id")
+    else:
+        return None
+    created_at = session.query(Message.created_at).filter(Message.id == msg_id).scalar()
+    if created_at is None:
+        raise LookupError(f"message {msg_id} not found")
+    return created_at, msg_id, inclusive
+
+def _export_seek(q, start):
+    if start is None:
+        return q
+    created_at, msg_id, inclusive = start
+    id_cond = Message.id >= msg_id if inclusive else Message.id > msg_id
+    return q.filter(or_(Message.created_at > created_at, and_(Message.created_at == created_at, id_cond)))
+
+def _export_prepare(request: Request):
+    """Общая часть экспортов: (filters, start) либо готовый JSONResponse с ошибкой."""
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    if not SessionLocal:
+        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
 
     session = SessionLocal()
+    try:
+        start = _export_start(request, session)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except LookupError as e:
+        return JSONResponse({"error": str(e)}, status_code=416, headers={"Accept-Ranges": "messages"})
+    finally:
+        session.close()
+    return _message_filters(request.query_params), start
 
-    def generate():
-        try:
-            q = session.query(Message, Conversation).join(Conversation, Message.conversation_id == Conversation.id)
-            if roles:
-                q = q.filter(Message.role.in_(roles))
-            if dt_from:
-                q = q.filter(Message.created_at >= dt_from)
-            if dt_to:
-                q = q.filter(Message.created_at <= dt_to)
-            if origin_param:
-                if origin_param.startswith("*"):
-                    q = q.filter(Conversation.origin.ilike(f"%{origin_param[1:]}") )
-                else:
-                    q = q.filter(Conversation.origin == origin_param)
-            if thread_param:
-                q = q.filter(Conversation.thread_id == thread_param)
-            if has_lead is True:
-                q = q.filter(Conversation.lead_id.isnot(None))
-            elif has_lead is False:
-                q = q.filter(Conversation.lead_id.is_(None))
-            if lead_param:
+def _iso_text(col):
+    # как datetime.isoformat(): микросекунды только если они не нулевые
+    return case(
+        (func.to_char(col, "US") == "000000", func.to_char(col, 'YYYY-MM-DD"T"HH24:MI:SS')),
+        else_=func.to_char(col, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+    )
+
+def _tool_args_csv_text():
+    # Postgres: tool_args через jsonb — \uXXXX старых строк раскрыты, разделители
+    # ", "/": " как у json.dumps; ключи в порядке jsonb. Пустое поле — для тех же
+    # значений, что falsy в Python (null, {}, [], "", false, 0).
+    from sqlalchemy.dialects.postgresql import JSONB
+    doc = Message.tool_args.cast(JSONB)
+    falsy = [literal_column(f"'{v}'::jsonb") for v in ("null", "{}", "[]", '""', "false", "0")]
+    return case((or_(doc.is_(None), doc.in_(falsy)), None), else_=doc.cast(Text))
+
+def _export_select(filters: dict, start, *, copy_text: bool = False):
+    """Core-select плоских строк экспорта (без ORM-объектов и identity map).
+    copy_text — колонки в текстовом виде для COPY … CSV, байт в байт как у
+    _csv_chunks: пустые строки — NULL (пустое поле без кавычек)."""
+    pg = engine.dialect.name == "postgresql"
+    if copy_text:
+        def text(col):
+            return func.nullif(col, "")
+        tool_args = _tool_args_csv_text()
+        msg_created_at, conv_created_at = _iso_text(Message.created_at), _iso_text(Conversation.created_at)
+        extra = ()
+    else:
+        def text(col):
+            return col
+        tool_args, msg_created_at, conv_created_at = Message.tool_args, Message.created_at, Conversation.created_at
+        extra = (_tool_args_csv_text().label("tool_args_csv"),) if pg else ()  # как в COPY — для CSV
+    stmt = (
+        select(
+            Message.id.label("msg_id"), text(Message.role).label("role"), text(Message.content).label("content"),
+            text(Message.tool_name).label("tool_name"), tool_args.label("tool_args"), msg_created_at.label("msg_created_at"),
+            Conversation.id.label("conv_id"), text(Conversation.thread_id).label("thread_id"), Conversation.lead_id,
+            text(Conversation.origin).label("origin"), conv_created_at.label("conv_created_at"),
+            *extra,
+        )
+        .select_from(Message)
+        .join(Conversation, Message.conversation_id == Conversation.id)
+    )
+    stmt = _export_seek(_filter_messages(stmt, filters), start)
+    return stmt.order_by(Message.created_at.asc(), Message.id.asc())
+
+def _export_rows(filters: dict, start):
+    """Строки экспорта по порядку. На Postgres stream_results — именованный
+    (server-side) курсор psycopg2, в памяти не больше EXPORT_BATCH_ROWS строк;
+    sqlite3 и так читает курсор лениво."""
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS).execute(_export_select(filters, start))
+        yield from result
+
+# COPY (SELECT …) TO STDOUT: Postgres сам формирует CSV, Python только
+# перекладывает байты. copy_expert блокирующий — он работает в отдельном
+# потоке и пишет буферами в ограниченную очередь (backpressure), генератор
+# ответа читает из неё. Параметры подставляются через cursor.mogrify.
+EXPORT_PG_COPY = os.getenv("EXPORT_PG_COPY", "1") in {"1", "true", "True", "yes", "on"}
+EXPORT_COPY_QUEUE = int(os.getenv("EXPORT_COPY_QUEUE", "16"))
+_COPY_EOF = object()
+
+class _CopyPipe:
+    """Файл для copy_expert: копит строки COPY в буфер и отдаёт его в очередь."""
+
+    def __init__(self):
+        self.queue: queue.Queue = queue.Queue(maxsize=EXPORT_COPY_QUEUE)
+        self.cancelled = threading.Event()
+        self.error: Optional[BaseException] = None
+        self._buf: list[bytes] = []
+        self._size = 0
+
+    def _put(self, item) -> None:
+        while True:
+            if self.cancelled.is_set():
+                raise IOError("export cancelled")
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data) -> int:
+        data = data.encode() if isinstance(data, str) else bytes(data)
+        self._buf.append(data)
+        self._size += len(data)
+        if self._size >= EXPORT_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if self._buf:
+            chunk = b"".join(self._buf)
+            self._buf, self._size = [], 0
+            self._put(chunk)
+
+def _copy_csv_available() -> bool:
+    return EXPORT_PG_COPY and engine is not None and engine.dialect.name == "postgresql"
+
+def _copy_csv_chunks(filters: dict, start, header: bool = True):
+    stmt = _export_select(filters, start, copy_text=True)
+    raw = engine.raw_connection()
+    pipe = _CopyPipe()
+    finished = False
+    try:
+        cur = raw.cursor()
+        compiled = stmt.compile(dialect=engine.dialect, compile_kwargs={"render_postcompile": True})
+        sql = cur.mogrify(str(compiled), compiled.params).decode()
+        copy_sql = f"COPY ({sql}) TO STDOUT WITH (FORMAT csv{', HEADER' if header else ''})"
+
+        def run():
+            try:
+                cur.copy_expert(copy_sql, pipe)
+                pipe.flush()
+            except BaseException as e:  # передаём в генератор ответа
+                pipe.error = e
+            finally:
                 try:
-                    q = q.filter(Conversation.lead_id == int(lead_param))
-                except Exception:
+                    pipe._put(_COPY_EOF)
+                except IOError:
                     pass
-            if tool_param:
-                if tool_param == "*":
-                    q = q.filter(Message.tool_name.isnot(None))
-                else:
-                    q = q.filter(Message.tool_name == tool_param)
-            if search_param:
-                q = q.filter(Message.content.ilike(f"%{search_param}%"))
 
-            q = q.order_by(Message.created_at.asc(), Message.id.asc())
-            for m, c in q.yield_per(1000):
-                row = {
-                    "id": m.id,
-                    "role": m.role,
-                    "content": m.content,
-                    "tool_name": m.tool_name,
-                    "tool_args": m.tool_args,
-                    "created_at": m.created_at.isoformat() if m.created_at else None,
-                    "conversation": {
-                        "id": c.id,
-                        "thread_id": c.thread_id,
-                        "lead_id": c.lead_id,
-                        "origin": c.origin,
-                        "created_at": c.created_at.isoformat() if c.created_at else None,
-                    }
-                }
-                yield json.dumps(row, ensure_ascii=False) + "\n"
-        finally:
-            session.close()
+        worker = threading.Thread(target=run, name="export-copy", daemon=True)
+        worker.start()
+        while True:
+            item = pipe.queue.get()
+            if item is _COPY_EOF:
+                break
+            yield item
+        worker.join()
+        if pipe.error is not None:
+            raise pipe.error
+        raw.commit()
+        finished = True
+    finally:
+        if not finished:
+            # клиент ушёл или COPY упал — останавливаем поток; соединение с
+            # прерванным COPY в пул не возвращаем
+            pipe.cancelled.set()
+            while True:
+                try:
+                    pipe.queue.get_nowait()
+                except queue.Empty:
+                    break
+            raw.invalidate()
+        raw.close()
+
+def _export_response(request: Request, body, media_type: str, start, headers: Optional[dict] = None, *, compress: bool = True, ranges: bool = True) -> StreamingResponse:
+    encoding = _export_encoding(request) if compress else None
+    headers = {"Accept-Ranges": "messages" if ranges else "none", **({"Vary": "Accept-Encoding"} if compress else {}), **(headers or {})}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    status = 200
+    if ranges and start is not None and start[2]:
+        status = 206
+        headers["Content-Range"] = f"messages {start[1]}-*/*"
+    return StreamingResponse(_compressed(_buffered(body), encoding), status_code=status, media_type=media_type, headers=headers)
+
+def _ndjson_lines(rows):
+    for r in rows:
+        yield _json_bytes({
+            "id": r.msg_id,
+            "role": r.role,
+            "content": r.content,
+            "tool_name": r.tool_name,
+            "tool_args": r.tool_args,
+            "created_at": r.msg_created_at.isoformat() if r.msg_created_at else None,
+            "conversation": {
+                "id": r.conv_id,
+                "thread_id": r.thread_id,
+                "lead_id": r.lead_id,
+                "origin": r.origin,
+                "created_at": r.conv_created_at.isoformat() if r.conv_created_at else None,
+            }
+        }) + b"\n"
+
+def _csv_chunks(rows, header: bool = True):
+    # на Postgres tool_args — тот же jsonb-текст, что отдаёт COPY (_tool_args_csv_text)
+    pg = engine.dialect.name == "postgresql"
+    sio = io.StringIO()
+    writer = csv.writer(sio)
+    if header:
+        writer.writerow(EXPORT_CSV_HEADER)
+    for r in rows:
+        writer.writerow([
+            r.msg_id, r.role, r.content, r.tool_name,
+            r.tool_args_csv if pg else json.dumps(r.tool_args, ensure_ascii=False) if r.tool_args else "",
+            r.msg_created_at.isoformat() if r.msg_created_at else "",
+            r.conv_id, r.thread_id, r.lead_id, r.origin,
+            r.conv_created_at.isoformat() if r.conv_created_at else "",
+        ])
+        if sio.tell() >= EXPORT_CHUNK_SIZE:
+            yield sio.getvalue().encode()
+            sio.seek(0)
+            sio.truncate(0)
+    yield sio.getvalue().encode()
+
+def _crlf_rows(chunks):
+    """COPY … CSV завершает строки \n, csv.writer — \r\n: перевод строки вне
+    кавычек становится \r\n, внутри полей остаётся как есть. Кавычка в CSV
+    всегда переключает состояние ("" внутри поля — два переключения)."""
+    quoted = False
+    for chunk in chunks:
+        parts = chunk.split(b'"')
+        for i in range(1 if quoted else 0, len(parts), 2):
+            parts[i] = parts[i].replace(b"\n", b"\r\n")
+        quoted ^= len(parts) % 2 == 0
+        yield b'"'.join(parts)
 
-    return StreamingResponse(generate(), media_type="application/x-ndjson")
+@app.get("/admin/export/messages.ndjson")
+async def admin_export_messages_ndjson(request: Request):
+    prepared = _export_prepare(request)
+    if isinstance(prepared, Response):
+        return prepared
+    filters, start = prepared
+    return _export_response(request, _ndjson_lines(_export_rows(filters, start)), "application/x-ndjson", start)
 
 @app.get("/admin/export/messages.csv")
 async def admin_export_messages_csv(request: Request):
+    prepared = _export_prepare(request)
+    if isinstance(prepared, Response):
+        return prepared
+    filters, start = prepared
+    # при докачке заголовок не повторяем — ответ дописывается к уже скачанному файлу
+    if _copy_csv_available():
+        body = _crlf_rows(_copy_csv_chunks(filters, start, header=start is None))
+    else:
+        body = _csv_chunks(_export_rows(filters, start), header=start is None)
+    return _export_response(request, body, "text/csv", start, {"Content-Disposition": "attachment; filename=messages.csv"})
+
+# ── Admin: columnar export (Parquet / Arrow IPC) ───────────────────────────
+# Типизированная выгрузка для аналитики; pyarrow — опциональная зависимость
+# (без неё эндпоинты отвечают 501). Строки копятся по колонкам и сбрасываются
+# row group'ами (Parquet) / record batch'ами (Arrow) по EXPORT_ROW_GROUP_ROWS,
+# так что память ограничена размером одной группы. Фильтры — как у NDJSON/CSV;
+# HTTP-сжатие не применяется — оба формата сжимаются внутри. Докачки нет: файл
+# нельзя дописать к частично скачанному, поэтому Range отклоняется (416), а
+# after=/after_id= отдают новый самостоятельный файл с сообщениями после id (200).
+EXPORT_ROW_GROUP_ROWS = int(os.getenv("EXPORT_ROW_GROUP_ROWS", "50000"))
+EXPORT_COLUMNAR_COMPRESSION = os.getenv("EXPORT_COLUMNAR_COMPRESSION", "zstd")
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+def _arrow_schema():
+    return pa.schema([
+        ("msg_id", pa.int64()),
+        ("role", pa.string()),
+        ("content", pa.large_string()),
+        ("tool_name", pa.string()),
+        ("tool_args", pa.string()),  # JSON-текст: структура у разных инструментов разная
+        ("msg_created_at", pa.timestamp("us")),
+        ("conv_id", pa.int64()),
+        ("thread_id", pa.string()),
+        ("lead_id", pa.int64()),
+        ("origin", pa.string()),
+        ("conv_created_at", pa.timestamp("us")),
+    ])
+
+class _ChunkSink(io.RawIOBase):
+    """Файл, в который пишет pyarrow; генератор забирает накопленное через drain()."""
+
+    def __init__(self):
+        self._parts: list[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        data = bytes(b)
+        self._parts.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+def _arrow_batches(rows, schema):
+    names = schema.names
+    cols = {name: [] for name in names}
+    n = 0
+    for r in rows:
+        for name in names:
+            cols[name].append(getattr(r, name))
+        if r.tool_args is not None:
+            cols["tool_args"][-1] = json.dumps(r.tool_args, ensure_ascii=False)
+        n += 1
+        if n >= EXPORT_ROW_GROUP_ROWS:
+            yield pa.RecordBatch.from_pydict(cols, schema=schema)
+            cols = {name: [] for name in names}
+            n = 0
+    if n:
+        yield pa.RecordBatch.from_pydict(cols, schema=schema)
+
+def _columnar_chunks(rows, fmt: str):
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    compression = EXPORT_COLUMNAR_COMPRESSION if EXPORT_COLUMNAR_COMPRESSION != "none" else None
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression=compression or "none")
+    else:
+        writer = pa.ipc.new_stream(sink, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+    try:
+        for batch in _arrow_batches(rows, schema):
+            writer.write_batch(batch)
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+async def _columnar_export(request: Request, fmt: str, media_type: str, filename: str):
+    prepared = _export_prepare(request)
+    if isinstance(prepared, Response):
+        return prepared
+    if pa is None:
+        return JSONResponse({"error": "pyarrow is not installed"}, status_code=501)
+    if request.headers.get("range"):
+        return JSONResponse(
+            {"error": f"Range is not supported for {fmt} exports; use after=<cursor> or after_id=<id> to get a new file"},
+            status_code=416, headers={"Accept-Ranges": "none"},
+        )
+    filters, start = prepared
+    body = _columnar_chunks(_export_rows(filters, start), fmt)
+    return _export_response(request, body, media_type, start, {"Content-Disposition": f"attachment; filename={filename}"}, compress=False, ranges=False)
+
+@app.get("/admin/export/messages.parquet")
+async def admin_export_messages_parquet(request: Request):
+    return await _columnar_export(request, "parquet", "application/vnd.apache.parquet", "messages.parquet")
+
+@app.get("/admin/export/messages.arrow")
+async def admin_export_messages_arrow(request: Request):
+    return await _columnar_export(request, "arrow", "application/vnd.apache.arrow.stream", "messages.arrows")
+
+@app.get("/admin/stats/persistence")
+async def admin_persistence_stats(request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    return JSONResponse({"message_writer": message_writer.stats()})
+
+@app.post("/admin/maintenance/requeue_dead_letters")
+async def admin_requeue_dead_letters(request: Request):
+    # повторная запись сообщений, не записанных за MESSAGE_WRITE_ATTEMPTS попыток
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    requeued = message_writer.requeue_dead_letters()
+    return JSONResponse({"requeued": requeued, "message_writer": message_writer.stats()})
+
+# ── Admin: Prometheus metrics ──────────────────────────────────────────────
+# Гистограммы/счётчики копятся в METRICS по ходу работы; gauge'и ниже
+# снимаются только в момент скрейпа. Токен — X-Admin-Token или
+# Authorization: Bearer (так его умеет передавать Prometheus).
+def _metric_family(name: str, kind: str, help_text: str, samples: list[tuple[dict, float]]) -> list[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_label_str(tuple(labels), tuple(labels.values()))} {_metric_value(value)}")
+    return lines
+
+def _scrape_gauges() -> list[str]:
+    lines: list[str] = []
+    pool = engine.pool if engine is not None else None
+    if pool is not None and hasattr(pool, "checkedout"):
+        lines += _metric_family("db_pool_size", "gauge", "Configured DB connection pool size.", [({}, pool.size())])
+        lines += _metric_family("db_pool_checked_out", "gauge", "DB connections currently in use.", [({}, pool.checkedout())])
+        lines += _metric_family("db_pool_overflow", "gauge", "DB connections opened beyond pool size.", [({}, max(0, pool.overflow()))])
+    lines += _metric_family("chat_runs_inflight", "gauge", "Assistant runs currently watched by the poller.", [({}, run_watcher.inflight)])
+
+    w = message_writer.stats()
+    lines += _metric_family("message_writer_queue_depth", "gauge", "Messages waiting in the write-behind queue.", [({}, w["queue_depth"])])
+    lines += _metric_family("message_writer_dead_letters", "gauge", "Messages kept in the dead-letter buffer after failed writes.", [({}, w["dead_letters"])])
+    lines += _metric_family("message_writer_running", "gauge", "Whether the write-behind thread is running.", [({}, int(bool(w["running"])))])
+    for key in ("enqueued", "overflow", "flushes", "flushed", "retried", "failed"):
+        lines += _metric_family(f"message_writer_{key}_total", "counter", f"Write-behind queue: {key}.", [({}, w[key])])
+
+    caches = {
+        "conversation": _conversation_cache.stats(),
+        "lead_thread": lead_threads._cache.stats(),
+        "lead_dedup": _lead_dedup_cache.stats(),
+        "openai_history": openai_history._cache.stats(),
+        "admin_count": _count_cache.stats(),
+        "opening_answer": opening_answers.stats(),
+    }
+    lines += _metric_family("cache_entries", "gauge", "Entries in in-process caches.", [({"cache": k}, v["size"]) for k, v in caches.items()])
+    lines += _metric_family("cache_hits_total", "counter", "In-process cache hits.", [({"cache": k}, v["hits"]) for k, v in caches.items()])
+    lines += _metric_family("cache_misses_total", "counter", "In-process cache misses.", [({"cache": k}, v["misses"]) for k, v in caches.items()])
+    lines += _metric_family("opening_answer_stores_total", "counter", "Opening-turn answers stored.", [({}, opening_answers.stores)])
+    lines += _metric_family("opening_answer_remote_purges_total", "counter", "Opening-turn cache purges picked up from other workers.", [({}, opening_answers.remote_purges)])
+
+    tp = warm_threads.stats()
+    lines += _metric_family("thread_pool_ready", "gauge", "Pre-created OpenAI threads ready to hand out.", [({}, tp["ready"])])
+    lines += _metric_family("thread_pool_target", "gauge", "Target size of the pre-warmed thread pool.", [({}, tp["target"])])
+    for key in ("hits", "misses", "expired", "created", "errors", "deleted", "delete_errors"):
+        lines += _metric_family(f"thread_pool_{key}_total", "counter", f"Pre-warmed thread pool: {key}.", [({}, tp[key])])
+
+    lines += _metric_family("bitrix_circuit_open", "gauge", "1 when the Bitrix24 circuit breaker is not closed.", [({}, int(bitrix.breaker.state != "closed"))])
+    lines += _metric_family("import_jobs_running", "gauge", "Import jobs running in this process.", [({}, len(import_jobs._tasks))])
+    return lines
+
+def _render_metrics() -> str:
+    lines: list[str] = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    lines.extend(_scrape_gauges())
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    auth = request.headers.get("authorization") or ""
+    if not (ADMIN_TOKEN and auth.startswith("Bearer ") and auth[7:].strip() == ADMIN_TOKEN):
+        try:
+            _require_admin(request)
+        except PermissionError as e:
+            return JSONResponse({"error": str(e)}, status_code=401)
+
+    return Response(_render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ── Admin: opening-turn answer cache ───────────────────────────────────────
+@app.get("/admin/cache/opening_answers")
+async def admin_opening_cache_stats(request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    return JSONResponse(opening_answers.stats())
+
+@app.post("/admin/cache/opening_answers/purge")
+async def admin_opening_cache_purge(request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    # без message — очищается весь кэш; с message (+origin) — одна запись.
+    # purged — число записей в этом воркере; scope=all_workers — остальные
+    # воркеры очистят свои копии в течение OPENING_CACHE_SYNC_INTERVAL
+    message = request.query_params.get("message")
+    purged, scope = await asyncio.to_thread(opening_answers.purge, message, request.query_params.get("origin", ""))
+    return JSONResponse({"purged": purged, "scope": scope, **opening_answers.stats()})
+
+# ── Admin: пересчёт статистики бесед ───────────────────────────────────────
+# Пересчитывает messages_count/last_message_at/… из messages диапазонами id,
+# каждый диапазон — отдельная транзакция, чтобы не держать блокировки на всю
+# таблицу. Нужен после ручных правок messages или для проверки расхождений.
+CONVERSATION_STATS_BATCH = int(os.getenv("CONVERSATION_STATS_BATCH", "5000"))
+
+def _backfill_conversation_stats_batched(batch: int) -> dict:
+    with engine.connect() as conn:
+        lo, hi = conn.execute(select(func.min(Conversation.id), func.max(Conversation.id))).one()
+    updated = batches = 0
+    if lo is not None:
+        for start in range(lo, hi + 1, batch):
+            with engine.begin() as conn:
+                updated += _backfill_conversation_stats(conn, start, start + batch - 1)
+            batches += 1
+    _count_cache.clear()
+    return {"updated": updated, "batches": batches}
+
+@app.post("/admin/maintenance/backfill_conversation_stats")
+async def admin_backfill_conversation_stats(request: Request):
     try:
         _require_admin(request)
     except PermissionError as e:
@@ -863,85 +3673,116 @@ async def admin_export_messages_csv(request: Request):
     if not SessionLocal:
         return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
 
-    qp = request.query_params
-    dt_from = _parse_dt(qp.get("from"))
-    dt_to = _parse_dt(qp.get("to"))
-    roles = [r.strip() for r in qp.get("role", "").split(',') if r.strip()] or None
-    origin_param = qp.get("origin")
-    thread_param = qp.get("thread_id")
-    has_lead = _parse_bool(qp.get("has_lead"))
-    lead_param = qp.get("lead_id")
-    tool_param = qp.get("tool_name")
-    search_param = qp.get("search")
+    batch = _parse_int(request.query_params.get("batch")) or CONVERSATION_STATS_BATCH
+    started = time.monotonic()
+    result = await asyncio.to_thread(_backfill_conversation_stats_batched, max(1, batch))
+    result["elapsed_s"] = round(time.monotonic() - started, 3)
+    return JSONResponse(result)
 
-    session = SessionLocal()
+# ── Admin: schema migrations ───────────────────────────────────────────────
+# Online-миграции (индексы CONCURRENTLY, backfill'ы) запускаются отсюда или
+# через `python main.py migrate` — в фоне, чтобы не упираться в таймаут HTTP.
+_online_migrations: dict = {"task": None, "started_at": None, "finished_at": None, "applied": [], "error": None}
 
-    def generate():
-        try:
-            q = session.query(Message, Conversation).join(Conversation, Message.conversation_id == Conversation.id)
-            if roles:
-                q = q.filter(Message.role.in_(roles))
-            if dt_from:
-                q = q.filter(Message.created_at >= dt_from)
-            if dt_to:
-                q = q.filter(Message.created_at <= dt_to)
-            if origin_param:
-                if origin_param.startswith("*"):
-                    q = q.filter(Conversation.origin.ilike(f"%{origin_param[1:]}") )
-                else:
-                    q = q.filter(Conversation.origin == origin_param)
-            if thread_param:
-                q = q.filter(Conversation.thread_id == thread_param)
-            if has_lead is True:
-                q = q.filter(Conversation.lead_id.isnot(None))
-            elif has_lead is False:
-                q = q.filter(Conversation.lead_id.is_(None))
-            if lead_param:
-                try:
-                    q = q.filter(Conversation.lead_id == int(lead_param))
-                except Exception:
-                    pass
-            if tool_param:
-                if tool_param == "*":
-                    q = q.filter(Message.tool_name.isnot(None))
-                else:
-                    q = q.filter(Message.tool_name == tool_param)
-            if search_param:
-                q = q.filter(Message.content.ilike(f"%{search_param}%"))
+def _migrations_status() -> dict:
+    applied = _load_applied_migrations(engine)
+    task = _online_migrations["task"]
+    return {
+        "migrations": [
+            {"version": v, "name": n, "online": online, "applied": v in applied}
+            for v, n, _fn, online in sorted(MIGRATIONS, key=lambda m: m[0])
+        ],
+        "running": task is not None and not task.done(),
+        "started_at": _online_migrations["started_at"],
+        "finished_at": _online_migrations["finished_at"],
+        "last_run": _online_migrations["applied"],
+        "error": _online_migrations["error"],
+    }
 
-            q = q.order_by(Message.created_at.asc(), Message.id.asc())
+async def _run_online_migrations() -> None:
+    try:
+        _online_migrations["applied"] = await asyncio.to_thread(_apply_online_migrations, engine)
+    except Exception as e:
+        _online_migrations["error"] = str(e)
+    finally:
+        _online_migrations["finished_at"] = _utcnow_naive().isoformat()
+    _count_cache.clear()
 
-            # CSV header
-            header = [
-                "msg_id", "role", "content", "tool_name", "tool_args", "msg_created_at",
-                "conv_id", "thread_id", "lead_id", "origin", "conv_created_at"
-            ]
-            sio = io.StringIO()
-            writer = csv.writer(sio)
-            writer.writerow(header)
-            yield sio.getvalue()
-            sio.seek(0)
-            sio.truncate(0)
+@app.get("/admin/maintenance/migrations")
+async def admin_list_migrations(request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
 
-            for m, c in q.yield_per(1000):
-                row = [
-                    m.id, m.role, m.content, m.tool_name, json.dumps(m.tool_args, ensure_ascii=False) if m.tool_args else "",
-                    m.created_at.isoformat() if m.created_at else "",
-                    c.id, c.thread_id, c.lead_id if c.lead_id is not None else "", c.origin,
-                    c.created_at.isoformat() if c.created_at else "",
-                ]
-                writer.writerow(row)
-                yield sio.getvalue()
-                sio.seek(0)
-                sio.truncate(0)
-        finally:
-            session.close()
+    if not engine:
+        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
+    return JSONResponse(await asyncio.to_thread(_migrations_status))
 
-    return StreamingResponse(generate(), media_type="text/csv", headers={
-        "Content-Disposition": "attachment; filename=messages.csv"
-    })
+@app.post("/admin/maintenance/migrations")
+async def admin_apply_migrations(request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    if not engine:
+        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
+    task = _online_migrations["task"]
+    if task is None or task.done():
+        _online_migrations.update(started_at=_utcnow_naive().isoformat(), finished_at=None, applied=[], error=None)
+        _online_migrations["task"] = asyncio.create_task(_run_online_migrations())
+    return JSONResponse(await asyncio.to_thread(_migrations_status), status_code=202)
 
 # ── Admin: import OpenAI thread messages into DB ───────────────────────────
+# Тред читается целиком (все страницы messages.list), уже сохранённые
+# сообщения отсекаются по external_id / content_hash одним индексным запросом,
+# новые пишутся одним multi-row INSERT в одной транзакции (_write_messages).
+def _import_known_keys(thread_id: str) -> tuple[set[str], set[str]]:
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(
+                Message.external_id, Message.content_hash, Message.role,
+                # текст нужен только строкам, которых ещё не коснулся backfill хэшей
+                case((Message.content_hash.is_(None), Message.content)).label("content"),
+            )
+            .join(Conversation, Message.conversation_id == Conversation.id)
+            .filter(Conversation.thread_id == thread_id)
+            .all()
+        )
+    finally:
+        session.close()
+    hashes = {r.content_hash or _content_hash(r.role, r.content or "") for r in rows}
+    return {r.external_id for r in rows if r.external_id}, hashes
+
+def _import_write(records: list[dict]) -> None:
+    session = SessionLocal()
+    try:
+        _write_messages(session, records)
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+async def _import_openai_thread(thread_id: str, origin: Optional[str], force: bool = False) -> dict:
+    known_ids, known_hashes = (set(), set()) if force else await asyncio.to_thread(_import_known_keys, thread_id)
+    records: list[dict] = []
+    skipped = 0
+    async for m in openai_history._iter_messages(thread_id):
+        item = _openai_message_item(m, include_tools=False)
+        if item is None:
+            continue
+        if not force and (m.id in known_ids or _content_hash(item["role"], item["content"]) in known_hashes):
+            skipped += 1
+            continue
+        created_at = datetime.fromtimestamp(m.created_at, timezone.utc) if getattr(m, "created_at", None) else None
+        records.append(_message_record(thread_id, origin, item["role"], item["content"], external_id=m.id, created_at=created_at))
+    if records:
+        await asyncio.to_thread(_import_write, records)
+    return {"thread_id": thread_id, "imported": len(records), "skipped": skipped, "force": force}
+
 @app.post("/admin/threads/{thread_id}/import_openai")
 async def admin_import_openai_thread(thread_id: str, request: Request):
     try:
@@ -957,50 +3798,464 @@ async def admin_import_openai_thread(thread_id: str, request: Request):
     # Read query flags
     force = (request.query_params.get("force", "false").lower() in {"1", "true", "yes", "on"})
 
-    # Build existing messages set for dedup when not forcing
-    existing_pairs: set[tuple[str, str]] = set()
+    try:
+        result = await _import_openai_thread(thread_id, origin, force)
+    except APIError as e:
+        return JSONResponse({"error": f"OpenAI fetch failed: {e}"}, status_code=502)
+    except IntegrityError as e:
+        # параллельный импорт того же треда успел записать те же сообщения
+        if DEBUG:
+            print(f"[import] {thread_id} conflict: {e}")
+        return JSONResponse({"error": "import conflicts with messages written concurrently; retry", "thread_id": thread_id}, status_code=409)
+    except SQLAlchemyError as e:
+        if DEBUG:
+            print(f"[import] {thread_id} db error: {e}")
+        return JSONResponse({"error": f"database error: {type(e).__name__}", "thread_id": thread_id}, status_code=500)
+    return JSONResponse(result)
+
+# ── Admin: bulk import jobs ────────────────────────────────────────────────
+# POST /admin/import_jobs {"thread_ids": [...]} | {"all": true} запускает
+# импорт тредов в фоне: IMPORT_JOB_CONCURRENCY воркеров на задачу берут треды
+# из ограниченной очереди и зовут _import_openai_thread. Прогресс и точка
+# продолжения (resume_after) сохраняются в import_jobs раз в
+# IMPORT_JOB_FLUSH_INTERVAL; прерванную задачу продолжает …/resume.
+# Задачи живут в процессе, который их запустил; heartbeat_at позволяет понять,
+# что процесс умер (статус running, но heartbeat старше IMPORT_JOB_STALE_AFTER).
+# Resume захватывает задачу одним условным UPDATE — два воркера не продолжат
+# одну и ту же задачу. Упавшие треды хранятся в failed_threads все и остаются
+# там, пока повтор не отработает.
+IMPORT_JOB_CONCURRENCY = int(os.getenv("IMPORT_JOB_CONCURRENCY", "4"))
+IMPORT_JOB_MAX_CONCURRENCY = int(os.getenv("IMPORT_JOB_MAX_CONCURRENCY", "16"))
+IMPORT_JOB_FLUSH_INTERVAL = float(os.getenv("IMPORT_JOB_FLUSH_INTERVAL", "2"))
+IMPORT_JOB_STALE_AFTER = float(os.getenv("IMPORT_JOB_STALE_AFTER", "60"))
+IMPORT_JOB_PAGE = 500
+
+def _utcnow_naive() -> datetime:
+    # колонки DateTime без tz: сравниваем с наивным UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _job_dict(job: ImportJob) -> dict:
+    elapsed = job.elapsed_s or 0.0
+    if job.status == "running" and job.started_at:
+        elapsed += max(0.0, (_utcnow_naive() - job.started_at.replace(tzinfo=None)).total_seconds())
+    threads_rate = job.processed / elapsed if elapsed > 0 else None
+    remaining = max(0, job.total - job.processed)
+    return {
+        "id": job.id,
+        "status": job.status,
+        "scope": job.scope,
+        "force": job.force,
+        "concurrency": job.concurrency,
+        "total": job.total,
+        "processed": job.processed,
+        "failed": job.failed,
+        "imported": job.imported,
+        "skipped": job.skipped,
+        "resume_after": job.resume_after,
+        "failed_threads": len(job.failed_threads or []),
+        "last_error": job.last_error,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": {
+            "threads_per_s": round(threads_rate, 3) if threads_rate else None,
+            "messages_per_s": round(job.imported / elapsed, 3) if elapsed > 0 else None,
+            "eta_s": round(remaining / threads_rate, 1) if threads_rate else None,
+        },
+        "created_at": _iso(job.created_at),
+        "started_at": _iso(job.started_at),
+        "finished_at": _iso(job.finished_at),
+        "heartbeat_at": _iso(job.heartbeat_at),
+    }
+
+def _job_update(job_id: int, **values) -> None:
     session = SessionLocal()
     try:
-        conv = session.query(Conversation).filter_by(thread_id=thread_id).one_or_none()
-        if conv:
-            if not force:
-                rows = (
-                    session.query(Message.role, Message.content)
-                    .filter(Message.conversation_id == conv.id)
-                    .all()
-                )
-                existing_pairs = {(r, c) for (r, c) in rows}
+        session.execute(update(ImportJob).where(ImportJob.id == job_id).values(**values))
+        session.commit()
     finally:
         session.close()
 
-    # Fetch from OpenAI
-    imported = 0
-    skipped = 0
+def _job_snapshot(job_id: int) -> Optional[dict]:
+    session = SessionLocal()
     try:
-        messages = client.beta.threads.messages.list(thread_id, order="asc")
-    except Exception as e:
-        return JSONResponse({"error": f"OpenAI fetch failed: {e}"}, status_code=502)
+        job = session.get(ImportJob, job_id)
+        return _job_dict(job) if job else None
+    finally:
+        session.close()
 
-    for m in messages.data:
-        role = getattr(m, "role", None)
-        if role not in {"user", "assistant"}:
-            continue
-        text_parts: list[str] = []
-        for part in getattr(m, "content", []) or []:
-            if getattr(part, "type", None) == "text" and getattr(part, "text", None):
-                value = getattr(getattr(part, "text", None), "value", None)
-                if isinstance(value, str) and value:
-                    text_parts.append(value)
-        content = "\n\n".join(text_parts).strip()
-        if not content:
-            continue
-        if not force and (role, content) in existing_pairs:
-            skipped += 1
-            continue
+class _JobProgress:
+    """Счётчики одного запуска и водяной знак resume_after.
+
+    Повторяемые треды (position=None) уже посчитаны в processed/failed прошлого
+    запуска и остаются в failed_threads, пока не будут обработаны."""
+
+    def __init__(self, job: ImportJob):
+        self.processed = job.processed
+        self.failed = job.failed
+        self.imported = job.imported
+        self.skipped = job.skipped
+        self.resume_after = job.resume_after
+        self.retry_pending: list[str] = list(job.failed_threads or [])
+        self.failed_threads: list[str] = []
+        self.last_error = job.last_error
+        self._failures_dirty = False
+        self._outstanding: set[int] = set()
+        self._last_produced = job.resume_after
+
+    def produced(self, position: Optional[int]) -> None:
+        if position is not None:
+            self._outstanding.add(position)
+            self._last_produced = position
+
+    def finished(self, position: Optional[int], thread_id: str, result: Optional[dict], error: Optional[Exception]) -> None:
+        if position is None:
+            self.retry_pending.remove(thread_id)
+            self._failures_dirty = True
+            if error is None:
+                self.failed -= 1
+        else:
+            self.processed += 1
+            if error is not None:
+                self.failed += 1
+        if error is None:
+            self.imported += result["imported"]
+            self.skipped += result["skipped"]
+        else:
+            self.last_error = f"{thread_id}: {error}"[:1000]
+            self.failed_threads.append(thread_id)
+            self._failures_dirty = True
+        if position is not None:
+            self._outstanding.discard(position)
+            self.resume_after = min(self._outstanding) - 1 if self._outstanding else self._last_produced
+
+    def values(self) -> dict:
+        values = {
+            "processed": self.processed,
+            "failed": self.failed,
+            "imported": self.imported,
+            "skipped": self.skipped,
+            "resume_after": self.resume_after,
+            "last_error": self.last_error,
+        }
+        if self._failures_dirty:  # список может быть большим — пишем только изменения
+            values["failed_threads"] = self.retry_pending + self.failed_threads
+            self._failures_dirty = False
+        return values
+
+class ImportJobRunner:
+    def __init__(self):
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._cancelled: set[int] = set()  # отмена по запросу, а не остановка процесса
+
+    def running(self, job_id: int) -> bool:
+        return job_id in self._tasks
+
+    def start(self, job_id: int) -> None:
+        task = asyncio.create_task(self._run(job_id), name=f"import-job-{job_id}")
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _t: self._tasks.pop(job_id, None))
+
+    async def cancel(self, job_id: int) -> bool:
+        task = self._tasks.get(job_id)
+        if task is None:
+            return False
+        self._cancelled.add(job_id)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def stop(self) -> None:
+        # при остановке процесса задачи сохраняют прогресс со статусом interrupted
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    def _load(job_id: int):
+        session = SessionLocal()
         try:
-            _save_message(thread_id, origin, role=role, content=content)
-            imported += 1
-        except Exception:
-            pass
+            job = session.get(ImportJob, job_id)
+            if job is None:
+                return None, 0
+            remaining = 0
+            if job.scope == "all":
+                remaining = session.query(func.count(Conversation.id)).filter(Conversation.id > job.resume_after).scalar() or 0
+            session.expunge(job)
+            return job, remaining
+        finally:
+            session.close()
+
+    @staticmethod
+    def _conversation_page(after_id: int) -> list[tuple[int, str]]:
+        session = SessionLocal()
+        try:
+            rows = (
+                session.query(Conversation.id, Conversation.thread_id)
+                .filter(Conversation.id > after_id)
+                .order_by(Conversation.id.asc())
+                .limit(IMPORT_JOB_PAGE)
+                .all()
+            )
+            return [(r.id, r.thread_id) for r in rows]
+        finally:
+            session.close()
+
+    async def _produce(self, job: ImportJob, retry: list[str], work: asyncio.Queue, progress: _JobProgress) -> None:
+        for thread_id in retry:
+            await work.put((None, thread_id))
+        if job.scope == "all":
+            after = job.resume_after
+            while True:
+                page = await asyncio.to_thread(self._conversation_page, after)
+                if not page:
+                    break
+                for position, thread_id in page:
+                    progress.produced(position)
+                    await work.put((position, thread_id))
+                after = page[-1][0]
+        else:
+            for position, thread_id in enumerate(job.thread_ids or [], start=1):
+                if position <= job.resume_after:
+                    continue
+                progress.produced(position)
+                await work.put((position, thread_id))
+
+    async def _run(self, job_id: int) -> None:
+        job, remaining = await asyncio.to_thread(self._load, job_id)
+        if job is None:
+            return
+        retry = list(job.failed_threads or [])
+        progress = _JobProgress(job)
+        total = len(job.thread_ids or []) if job.scope == "threads" else job.processed + remaining
+        run_started = _utcnow_naive()
+        await asyncio.to_thread(
+            _job_update, job_id, status="running", total=total, started_at=run_started,
+            heartbeat_at=run_started, finished_at=None,
+        )
+
+        concurrency = max(1, min(IMPORT_JOB_MAX_CONCURRENCY, job.concurrency or IMPORT_JOB_CONCURRENCY))
+        work: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+        async def flush(**extra) -> None:
+            now = _utcnow_naive()
+            values = progress.values()
+            values["heartbeat_at"] = now
+            if "status" in extra:
+                values["elapsed_s"] = (job.elapsed_s or 0.0) + (now - run_started).total_seconds()
+            values.update(extra)
+            await asyncio.to_thread(_job_update, job_id, **values)
+
+        async def ticker() -> None:
+            while True:
+                await asyncio.sleep(IMPORT_JOB_FLUSH_INTERVAL)
+                await flush()
+
+        async def worker() -> None:
+            while True:
+                item = await work.get()
+                if item is None:
+                    return
+                position, thread_id = item
+                result = error = None
+                try:
+                    result = await _import_openai_thread(thread_id, job.origin, job.force)
+                except Exception as e:
+                    error = e
+                    if DEBUG:
+                        print(f"[import-job {job_id}] {thread_id} failed: {e}")
+                progress.finished(position, thread_id, result, error)
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        workers.append(asyncio.create_task(ticker()))
+        try:
+            await self._produce(job, retry, work, progress)
+            for _ in range(concurrency):
+                await work.put(None)
+            await asyncio.gather(*workers[:concurrency])
+            workers[-1].cancel()
+            await asyncio.gather(workers[-1], return_exceptions=True)
+        except asyncio.CancelledError:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            status = "cancelled" if job_id in self._cancelled else "interrupted"
+            self._cancelled.discard(job_id)
+            await asyncio.shield(flush(status=status, finished_at=_utcnow_naive()))
+            raise
+        except Exception as e:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            progress.last_error = f"job: {e}"[:1000]
+            await flush(status="failed", finished_at=_utcnow_naive())
+            return
+        await flush(status="completed", finished_at=_utcnow_naive())
+
+import_jobs = ImportJobRunner()
+
+def _resolve_import_job_threads(body: dict) -> Optional[list[str]]:
+    thread_ids = body.get("thread_ids")
+    if not isinstance(thread_ids, list):
+        return None
+    seen: set[str] = set()
+    result = []
+    for tid in thread_ids:
+        if isinstance(tid, str) and tid.strip() and tid.strip() not in seen:
+            seen.add(tid.strip())
+            result.append(tid.strip())
+    return result
+
+def _claim_import_job(job_id: int) -> bool:
+    # атомарный захват: задача не идёт нигде (или её процесс перестал слать heartbeat)
+    now = _utcnow_naive()
+    stale = now - timedelta(seconds=IMPORT_JOB_STALE_AFTER)
+    session = SessionLocal()
+    try:
+        claimed = session.execute(
+            update(ImportJob)
+            .where(
+                ImportJob.id == job_id,
+                or_(ImportJob.status.notin_(["running", "pending"]), ImportJob.heartbeat_at < stale),
+            )
+            .values(status="pending", heartbeat_at=now)
+        ).rowcount
+        session.commit()
+        return claimed == 1
+    finally:
+        session.close()
+
+def _create_import_job(values: dict) -> int:
+    session = SessionLocal()
+    try:
+        job = ImportJob(**values)
+        session.add(job)
+        session.commit()
+        return job.id
+    finally:
+        session.close()
+
+@app.post("/admin/import_jobs")
+async def admin_create_import_job(request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    if not SessionLocal:
+        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
+
+    try:
+        body = await request.json()
+    except Exception:
+        body = None
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "JSON body expected: {\"thread_ids\": [...]} or {\"all\": true}"}, status_code=400)
+
+    if body.get("all") is True:
+        scope, thread_ids = "all", None
+    else:
+        scope, thread_ids = "threads", _resolve_import_job_threads(body)
+        if not thread_ids:
+            return JSONResponse({"error": "thread_ids must be a non-empty list of strings (or pass all=true)"}, status_code=400)
+
+    concurrency = _parse_int(str(body.get("concurrency", ""))) or IMPORT_JOB_CONCURRENCY
+    job_id = await asyncio.to_thread(_create_import_job, {
+        "status": "pending",
+        "scope": scope,
+        "thread_ids": thread_ids,
+        "origin": request.headers.get("origin", ""),
+        "force": bool(body.get("force", False)),
+        "concurrency": max(1, min(IMPORT_JOB_MAX_CONCURRENCY, concurrency)),
+        "total": len(thread_ids or []),
+        "heartbeat_at": _utcnow_naive(),
+    })
+    import_jobs.start(job_id)
+    return JSONResponse(await asyncio.to_thread(_job_snapshot, job_id), status_code=202)
+
+@app.get("/admin/import_jobs")
+async def admin_list_import_jobs(request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    if not SessionLocal:
+        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
+
+    limit = max(1, min(200, _parse_int(request.query_params.get("limit")) or 50))
+
+    def load() -> list[dict]:
+        session = SessionLocal()
+        try:
+            return [_job_dict(j) for j in session.query(ImportJob).order_by(ImportJob.id.desc()).limit(limit).all()]
+        finally:
+            session.close()
+
+    return JSONResponse({"items": await asyncio.to_thread(load)})
+
+@app.get("/admin/import_jobs/{job_id}")
+async def admin_get_import_job(job_id: int, request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    if not SessionLocal:
+        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
+
+    job = await asyncio.to_thread(_job_snapshot, job_id)
+    if job is None:
+        return JSONResponse({"error": "import job not found"}, status_code=404)
+    job["active_here"] = import_jobs.running(job_id)
+    return JSONResponse(job)
+
+@app.post("/admin/import_jobs/{job_id}/resume")
+async def admin_resume_import_job(job_id: int, request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    if not SessionLocal:
+        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
+
+    job = await asyncio.to_thread(_job_snapshot, job_id)
+    if job is None:
+        return JSONResponse({"error": "import job not found"}, status_code=404)
+    if import_jobs.running(job_id):
+        return JSONResponse({"error": "import job is already running"}, status_code=409)
+    if job["status"] == "completed" and not job["failed_threads"]:
+        return JSONResponse({"error": "import job is already completed"}, status_code=409)
+    if not await asyncio.to_thread(_claim_import_job, job_id):
+        return JSONResponse({"error": "import job is running in another process"}, status_code=409)
+    import_jobs.start(job_id)
+    return JSONResponse(await asyncio.to_thread(_job_snapshot, job_id), status_code=202)
+
+@app.post("/admin/import_jobs/{job_id}/cancel")
+async def admin_cancel_import_job(job_id: int, request: Request):
+    try:
+        _require_admin(request)
+    except PermissionError as e:
+        return JSONResponse({"error": str(e)}, status_code=401)
+
+    if not SessionLocal:
+        return JSONResponse({"error": "DATABASE_URL is not configured"}, status_code=501)
+
+    if not await import_jobs.cancel(job_id):
+        return JSONResponse({"error": "import job is not running in this process"}, status_code=409)
+    return JSONResponse(await asyncio.to_thread(_job_snapshot, job_id))
+
+if __name__ == "__main__":
+    import sys
 
-    return JSONResponse({"thread_id": thread_id, "imported": imported, "skipped": skipped, "force": force})
+    # python main.py migrate — применить online-миграции (индексы, backfill'ы) и выйти
+    if sys.argv[1:] != ["migrate"]:
+        print("usage: python main.py migrate", file=sys.stderr)
+        sys.exit(2)
+    if not engine:
+        print("DATABASE_URL is not configured", file=sys.stderr)
+        sys.exit(2)
+    pending = _pending_online_migrations(engine)
+    print(f"pending online migrations: {', '.join(f'{v} {n}' for v, n, _fn in pending) or 'none'}")
+    for item in _apply_online_migrations(engine):
+        print(f"applied {item['version']} {item['name']} in {item['elapsed_s']}s")
@@ -0,0 +1,184 @@
+"""BitrixClient и CircuitBreaker против заглушки Bitrix24 (httpx.MockTransport).
+
+    python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import main  # noqa: E402
+
+WEBHOOK = "https://bitrix.test/rest/1/token"
+
+
+class StubBitrix:
+    """Отвечает по очереди заданными ответами; последний повторяется."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests: list[httpx.Request] = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        reply = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def ok(result=1) -> httpx.Response:
+    return httpx.Response(200, json={"result": result})
+
+
+def fail(status=503) -> httpx.Response:
+    return httpx.Response(status, text="unavailable")
+
+
+def make_client(stub, *, max_retries=0, threshold=2, reset_after=0.05, probe_timeout=1.0) -> main.BitrixClient:
+    return main.BitrixClient(
+        WEBHOOK,
+        max_retries=max_retries,
+        breaker=main.CircuitBreaker(threshold, reset_after, probe_timeout),
+        http=httpx.AsyncClient(transport=httpx.MockTransport(stub)),
+    )
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # backoff без ожидания и без jitter: записываем запрошенные паузы
+    recorded: list[float] = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(delay, *args, **kwargs):
+        recorded.append(delay)
+        await real_sleep(0)
+
+    monkeypatch.setattr(main.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(main.random, "uniform", lambda a, b: 1.0)
+    monkeypatch.setattr(main, "BITRIX_RETRY_BACKOFF", 0.5)
+    return recorded
+
+
+def test_retries_with_exponential_backoff(sleeps):
+    stub = StubBitrix(fail(), fail(), ok(42))
+    client = make_client(stub, max_retries=3)
+    assert asyncio.run(client.call("crm.lead.get", {"id": 1})) == 42
+    assert len(stub.requests) == 3
+    assert sleeps == [0.5, 1.0]
+    assert client.breaker.state == "closed"
+
+
+def test_gives_up_after_max_retries(sleeps):
+    stub = StubBitrix(fail())
+    client = make_client(stub, max_retries=2, threshold=5)
+    with pytest.raises(main.BitrixError):
+        asyncio.run(client.call("crm.lead.get", {"id": 1}))
+    assert len(stub.requests) == 3
+    assert sleeps == [0.5, 1.0]
+    assert client.breaker.failures == 1
+
+
+def test_non_idempotent_call_is_not_retried_after_5xx(sleeps):
+    stub = StubBitrix(fail(), ok())
+    client = make_client(stub, max_retries=3)
+    with pytest.raises(main.BitrixError):
+        asyncio.run(client.call("crm.lead.add", {"fields": {}}, idempotent=False))
+    assert len(stub.requests) == 1
+    assert sleeps == []
+
+
+def test_non_idempotent_call_is_retried_when_not_sent(sleeps):
+    stub = StubBitrix(httpx.ConnectError("refused"), ok(7))
+    client = make_client(stub, max_retries=3)
+    assert asyncio.run(client.call("crm.lead.add", {"fields": {}}, idempotent=False)) == 7
+    assert len(stub.requests) == 2
+
+
+def test_validation_error_does_not_trip_breaker(sleeps):
+    stub = StubBitrix(httpx.Response(400, json={"error": "ERROR_CORE", "error_description": "bad phone"}))
+    client = make_client(stub, max_retries=3, threshold=1)
+    with pytest.raises(main.BitrixError, match="bad phone"):
+        asyncio.run(client.call("crm.lead.add", {"fields": {}}, idempotent=False))
+    assert len(stub.requests) == 1
+    assert client.breaker.state == "closed"
+
+
+def test_breaker_open_half_open_closed(sleeps):
+    stub = StubBitrix(fail(), fail(), fail(), ok(1))
+    client = make_client(stub, threshold=2, reset_after=0.05)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(main.BitrixError):
+                await client.call("crm.lead.get", {"id": 1})
+        assert client.breaker.state == "open"
+
+        # open: запрос к Bitrix не уходит
+        with pytest.raises(main.CircuitOpenError):
+            await client.call("crm.lead.get", {"id": 1})
+        assert len(stub.requests) == 2
+
+        # после reset_after — одна проба; неудачная снова открывает breaker
+        time.sleep(0.06)
+        with pytest.raises(main.BitrixError) as e:
+            await client.call("crm.lead.get", {"id": 1})
+        assert not isinstance(e.value, main.CircuitOpenError)
+        assert client.breaker.state == "open"
+        assert len(stub.requests) == 3
+
+        # удачная проба закрывает breaker
+        time.sleep(0.06)
+        assert await client.call("crm.lead.get", {"id": 1}) == 1
+        assert client.breaker.state == "closed"
+        assert client.breaker.failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_half_open_allows_a_single_probe(sleeps):
+    client = make_client(StubBitrix(fail()), threshold=1, reset_after=0.05)
+    breaker = client.breaker
+    with pytest.raises(main.BitrixError):
+        asyncio.run(client.call("crm.lead.get", {"id": 1}))
+    time.sleep(0.06)
+    assert breaker.allow() is True
+    assert breaker.state == "half_open"
+    assert breaker.allow() is False  # вторая проба, пока первая не отчиталась
+
+
+def test_cancelled_probe_reopens_breaker():
+    async def hang(request):
+        await asyncio.sleep(10)
+        return ok()
+
+    client = main.BitrixClient(
+        WEBHOOK, max_retries=0,
+        breaker=main.CircuitBreaker(1, 0.05, 1.0),
+        http=httpx.AsyncClient(transport=httpx.MockTransport(hang)),
+    )
+
+    async def scenario():
+        client.breaker.record_failure()
+        await asyncio.sleep(0.06)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.call("crm.lead.get", {"id": 1}), 0.05)
+        assert client.breaker.state == "open"
+
+    asyncio.run(scenario())
+
+
+def test_stale_half_open_probe_is_replaced():
+    breaker = main.CircuitBreaker(1, 0.05, 0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow() is True   # проба ушла и не отчиталась
+    time.sleep(0.06)
+    assert breaker.allow() is True   # по probe_timeout — новая проба
+    assert breaker.state == "half_open"